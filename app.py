@@ -5,25 +5,36 @@ Current implementation is limited to the data from
 APDM Opal V2 only / will add more sensors in the future
 """
 import sys
+import threading
 import os
-import numpy as np
-import pandas as pd
-import pytz
 from PyQt6.QtWidgets import (QMessageBox, QMainWindow, QApplication,
                              QComboBox, QLabel, QWidget, QToolBar,
                              QStatusBar, QDialog, QVBoxLayout, QGridLayout,
                              QHBoxLayout, QStackedLayout, QTabWidget,
-                             QFileDialog, QPushButton, QGroupBox, QLineEdit)
+                             QFileDialog, QPushButton, QGroupBox, QLineEdit,
+                             QToolButton, QTableWidget, QTableWidgetItem)
 from PyQt6.QtGui import QAction, QIcon, QPixmap, QPalette, QColor
-from PyQt6.QtCore import Qt, QSize
-import apdm
-import axivity
+from PyQt6.QtCore import Qt, QSize, QObject, QThread, pyqtSignal
+from lazy import LazyModule, warm_up
+from qtshared import timezone_model
+
+# Imported on first use, or by warm_up once the main window shows
+np = LazyModule('numpy')
+cache = LazyModule('cache')
+h5index = LazyModule('h5index')
+instrument = LazyModule('instrument')
+pipeline = LazyModule('pipeline')
+redcap = LazyModule('redcap')
 
 basedir = os.path.dirname(__file__)
 workdir = os.path.abspath(os.curdir)
 
 SUBJECT = None
 
+# Columns of the stage timings panel (see ProcessingWindow.show_timings)
+TIMING_COLUMNS = ['Stage', 'Side', 'Wall (s)', 'CPU (s)', 'Peak RSS (MB)',
+                  'RSS growth (MB)', 'Arrays']
+
 class Color(QWidget):
     """ This should be replaced with the actual figures """
     def __init__(self, color):
@@ -103,6 +114,65 @@ class MainWindow(QMainWindow):
         self.sensortype.blockSignals(False)
         self.win = None
 
+class PreprocessWorker(QObject):
+    """ Runs the preprocessing off the GUI thread (see run_preprocess)
+
+    Parameters
+    ----------
+        job: pipeline.OpalJob or pipeline.Ax6Job
+            the subject to load and preprocess
+
+        memo: pipeline.StageMemo
+            stage results of the window's earlier runs
+    """
+    progress = pyqtSignal(int, str)     # steps begun so far, stage name
+    finished = pyqtSignal(dict)         # pipeline.preprocess output
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+    timings = pyqtSignal(list)          # instrument.Recorder records
+
+    def __init__(self, job, memo):
+        super().__init__()
+        self.job = job
+        self.memo = memo
+        self.is_cancelled = False
+        # Both sides report from their own thread (see pipeline.STAGES),
+        # so steps are counted here to keep the number going up
+        self.steps = 0
+        self.stage = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        recorder = instrument.Recorder()
+        try:
+            # Hashing the input files for the cache key also runs here
+            outdict = pipeline.run_job(self.job, self.report,
+                                       store=cache.Cache(), memo=self.memo,
+                                       recorder=recorder)
+        except pipeline.Cancelled:
+            outcome = (self.cancelled,)
+        except Exception as err:
+            outcome = (self.failed, f"{type(err).__name__}: {err}")
+        else:
+            outcome = (self.finished, outdict)
+        # The stages that did run, before the outcome ends the thread
+        self.timings.emit(recorder.records)
+        outcome[0].emit(*outcome[1:])
+
+    def report(self, stage):
+        """ progress callback; stops the run once cancelled """
+        if self.is_cancelled:
+            raise pipeline.Cancelled
+        with self.lock:
+            self.steps += 1
+            step = self.steps
+            self.stage = stage
+        self.progress.emit(step, stage)
+
+    def cancel(self):
+        """ stop before the next stage (the current one runs to its end) """
+        self.is_cancelled = True
+
 class ProcessingWindow(QMainWindow):
     """ Template class that will be inherited by either
     APDMWindow or AxivityWindow """
@@ -112,6 +182,13 @@ class ProcessingWindow(QMainWindow):
         self.timezone = QComboBox()
         self.sensortype = ''    # will be inherited
         self.setWindowTitle('Preprocessing window')
+        self.setStatusBar(QStatusBar(self))
+        # Set while run_preprocess is running
+        self.worker_thread = None
+        self.worker = None
+        # Stage results kept between runs, so that changing the timezone
+        # or the right label only reruns what depends on it
+        self.memo = pipeline.StageMemo()
         layout = QGridLayout()
 
         # GroupBox3: Study detail
@@ -121,7 +198,7 @@ class ProcessingWindow(QMainWindow):
         infohbox = QHBoxLayout()
         infogrpbox.setLayout(infohbox)
         infolbl = QLabel("Timezone of the study site: ")
-        self.timezone.addItems(pytz.all_timezones)
+        self.timezone.setModel(timezone_model())
         infohbox.addWidget(infolbl)
         infohbox.addWidget(self.timezone)
 
@@ -206,70 +283,135 @@ class ProcessingWindow(QMainWindow):
 
         plot_layout.addWidget(tabs)
 
+        # Stage timings of the last run, folded away by default
+        self.timings_button = QToolButton()
+        self.timings_button.setText("Stage timings")
+        self.timings_button.setToolButtonStyle(
+                Qt.ToolButtonStyle.ToolButtonTextBesideIcon)
+        self.timings_button.setArrowType(Qt.ArrowType.RightArrow)
+        self.timings_button.setCheckable(True)
+        self.timings_button.toggled.connect(self.toggle_timings)
+        layout.addWidget(self.timings_button, 12,0,1,9)
+
+        self.timings_table = QTableWidget(0, len(TIMING_COLUMNS))
+        self.timings_table.setHorizontalHeaderLabels(TIMING_COLUMNS)
+        self.timings_table.setEditTriggers(
+                QTableWidget.EditTrigger.NoEditTriggers)
+        self.timings_table.setVisible(False)
+        layout.addWidget(self.timings_table, 13,0,1,9)
+
         # This will be used in child classes
         self.sharedlayout = layout
 
+        # Run / Cancel / Clear; placed by the child classes
+        self.run_button = QPushButton("Run")
+        self.run_button.clicked.connect(self.run_preprocess)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_preprocess)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.setToolTip(
+                "Stops once the current stage finishes; loading a file "
+                "cannot be interrupted")
+
     def sensor_specific_housekeeping(self):
-        """ This will be modified in the inherited class """
+        """ This will be modified in the inherited class
+
+        Returns a pipeline job (pipeline.OpalJob or pipeline.Ax6Job),
+        with everything it needs read from the window beforehand.
+        """
 
     def run_preprocess(self):
-        """ This will calculate kinematic variables """
+        """ This will calculate kinematic variables
+
+        The work happens on a QThread so the window stays responsive;
+        each stage is shown in the status bar.
+        """
+        if self.worker_thread is not None:
+            return
         # Let's have a sensor-specific function here
-        SUBJECT = self.sensor_specific_housekeeping()
-
-        lmovs = SUBJECT.get_mov()
-        rmovs = SUBJECT.get_mov('R')
-        lmovs_del, rmovs_del = map(apdm.cycle_filt, [lmovs, rmovs])
-
-        # average acceleration per mov / peak acc per mov
-        laccpmov = SUBJECT.acc_per_mov(movmat=lmovs_del)
-        raccpmov = SUBJECT.acc_per_mov(side='R', movmat=rmovs_del)
-
-        # hours (sleep, awake) calculation
-        record_len = list(SUBJECT.info.recordlen.values())
-        lsleep, rsleep = map(apdm.time_asleep,\
-                [lmovs_del, rmovs_del], record_len)
-
-        # Rounding up sleep times to nearest 5 minutes
-        lsleep_5m, rsleep_5m = map(
-                lambda x: x/1200 - np.mod(x/1200, 5), [lsleep, rsleep])
-
-        lrec_hr = record_len[0]/72000   # 72000 = 20(Hz)*3600(seconds)
-        rrec_hr = record_len[1]/72000
-
-        lsleep_hr, rsleep_hr = map(
-                lambda x: x/60, [lsleep_5m, rsleep_5m])
-
-        awake_hrs = [lrec_hr - lsleep_hr, rrec_hr - rsleep_hr]
-
-        lmovrate = lmovs_del.shape[0] / awake_hrs[0]
-        rmovrate = rmovs_del.shape[0] / awake_hrs[1]
-
-        record_hours_newtxt = str(np.mean([lrec_hr, rrec_hr]))
-        sleep_hours_newtxt = str(np.mean([lsleep_hr, rsleep_hr]))
-        awake_hours_newtxt = str(np.mean(awake_hrs))
-        bouts_l_cnt_newtxt = str(lmovrate)
-        bouts_r_cnt_newtxt = str(rmovrate)
-        # median does not have the 'dtype' argument
-        avgacc_l_newtxt = str(
-                np.round(np.median(laccpmov[:,1]),2))
-        avgacc_r_newtxt = str(
-                np.round(np.median(raccpmov[:,1]),2))
-        peakacc_l_newtxt = str(
-                np.round(np.median(laccpmov[:,2]),2))
-        peakacc_r_newtxt = str(
-                np.round(np.median(raccpmov[:,2]),2))
-
-        # set new texts
-        self.record_hours.setText(record_hours_newtxt)
-        self.awake_hours.setText(awake_hours_newtxt)
-        self.sleep_hours.setText(sleep_hours_newtxt)
-        self.bouts_l_cnt.setText(bouts_l_cnt_newtxt)
-        self.bouts_r_cnt.setText(bouts_r_cnt_newtxt)
-        self.avgacc_l.setText("".join([avgacc_l_newtxt, ' m/s^2']))
-        self.avgacc_r.setText("".join([avgacc_r_newtxt, ' m/s^2']))
-        self.peakacc_l.setText("".join([peakacc_l_newtxt, ' m/s^2']))
-        self.peakacc_r.setText("".join([peakacc_r_newtxt, ' m/s^2']))
+        job = self.sensor_specific_housekeeping()
+        self.worker_thread = QThread()
+        self.worker = PreprocessWorker(job, self.memo)
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.timings.connect(self.show_timings)
+        self.worker.finished.connect(self.show_outputs)
+        self.worker.failed.connect(
+                lambda msg: self.statusBar().showMessage(f"Failed: {msg}"))
+        self.worker.cancelled.connect(
+                lambda: self.statusBar().showMessage("Cancelled"))
+        for signal in [self.worker.finished, self.worker.failed,
+                       self.worker.cancelled]:
+            signal.connect(self.worker_thread.quit)
+        self.worker_thread.finished.connect(self.preprocess_done)
+        self.run_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.worker_thread.start()
+
+    def show_progress(self, step, stage):
+        self.statusBar().showMessage(
+                f"Running {step}/{len(pipeline.STAGES)}: {stage}...")
+
+    def cancel_preprocess(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancel_button.setEnabled(False)
+            stage = self.worker.stage or 'load'
+            self.statusBar().showMessage(
+                    f"Cancelling once the current stage ({stage}) "
+                    "finishes...")
+
+    def preprocess_done(self):
+        """ the worker thread has stopped, whatever the outcome """
+        self.worker.deleteLater()
+        self.worker_thread.deleteLater()
+        self.worker = None
+        self.worker_thread = None
+        self.run_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
+    def toggle_timings(self, checked):
+        self.timings_button.setArrowType(
+                Qt.ArrowType.DownArrow if checked else Qt.ArrowType.RightArrow)
+        self.timings_table.setVisible(checked)
+
+    def show_timings(self, records):
+        """ fill the timings panel, one row per instrument record """
+        self.timings_table.setRowCount(len(records))
+        for row, record in enumerate(records):
+            stage = record['stage']
+            if 'hit' in record:
+                stage += ' (hit)' if record['hit'] else ' (miss)'
+            if 'error' in record:
+                stage += f" ({record['error']})"
+            arrays = ', '.join(
+                    f"{name} {'x'.join(map(str, x['shape']))} "
+                    f"({x['mb']:.1f} MB)"
+                    for name, x in record.get('arrays', {}).items())
+            cells = [stage, record.get('side', '')] + [
+                    '' if record.get(x) is None else format(record[x], fmt)
+                    for x, fmt in [('wall_s', '.3f'), ('cpu_s', '.3f'),
+                                   ('peak_rss_mb', '.1f'),
+                                   ('rss_growth_mb', '.1f')]] + [arrays]
+            for col, text in enumerate(cells):
+                self.timings_table.setItem(row, col, QTableWidgetItem(text))
+        self.timings_table.resizeColumnsToContents()
+
+    def show_outputs(self, outdict):
+        """ set the output labels from pipeline.preprocess results """
+        self.statusBar().showMessage("Done")
+        self.record_hours.setText(str(outdict['record_hours']))
+        self.awake_hours.setText(str(outdict['awake_hours']))
+        self.sleep_hours.setText(str(outdict['sleep_hours']))
+        self.bouts_l_cnt.setText(str(outdict['movrate_l']))
+        self.bouts_r_cnt.setText(str(outdict['movrate_r']))
+        for label, key in [(self.avgacc_l, 'avgacc_l'),
+                           (self.avgacc_r, 'avgacc_r'),
+                           (self.peakacc_l, 'peakacc_l'),
+                           (self.peakacc_r, 'peakacc_r')]:
+            label.setText("".join([str(np.round(outdict[key], 2)),
+                                   ' m/s^2']))
 
 class AxivityWindow(ProcessingWindow):
     """ This is the window that will handle
@@ -329,13 +471,12 @@ class AxivityWindow(ProcessingWindow):
         hbox_bottom = QHBoxLayout()
 
         # This should be 'deactivated' when there's no file loaded
-        run_button = QPushButton("Run")
-        run_button.clicked.connect(self.run_preprocess)
         clear_button = QPushButton("Clear")
         clear_button.clicked.connect(self.clear_screen)
 
         hbox_bottom.addStretch(7)
-        hbox_bottom.addWidget(run_button)
+        hbox_bottom.addWidget(self.run_button)
+        hbox_bottom.addWidget(self.cancel_button)
         hbox_bottom.addWidget(clear_button)
 
         layout.addLayout(hbox_bottom, 11,0,1,9)
@@ -359,9 +500,8 @@ class AxivityWindow(ProcessingWindow):
                 self.rcwa_loaded.setText(cwa_tempname[0])
 
     def sensor_specific_housekeeping(self):
-        SUBJECT = axivity.Ax6(self.cwa_l_filename, 
+        return pipeline.Ax6Job(self.cwa_l_filename,
                 self.cwa_r_filename)
-        return SUBJECT
 
     def clear_screen(self):
         """ clear_screen is a function that clears
@@ -373,6 +513,8 @@ class AxivityWindow(ProcessingWindow):
         """
         self.cwa_l_filename = ""
         self.cwa_r_filename = ""
+        self.memo = pipeline.StageMemo()
+        self.timings_table.setRowCount(0)
         self.lcwa_loaded.setText("")
         self.rcwa_loaded.setText("")
         # clear outcome variables
@@ -463,7 +605,6 @@ class APDMWindow(ProcessingWindow):
         infohbox = QHBoxLayout()
         infogrpbox.setLayout(infohbox)
         infolbl = QLabel("Timezone of the study site: ")
-        self.timezone.addItems(pytz.all_timezones)
 
         # user input for the label used to identify the 'Right' side
         self.label_r = QLineEdit(self)
@@ -478,13 +619,12 @@ class APDMWindow(ProcessingWindow):
         hbox_bottom = QHBoxLayout()
 
         # This should be 'deactivated' when there's no file loaded
-        run_button = QPushButton("Run")
-        run_button.clicked.connect(self.run_preprocess)
         clear_button = QPushButton("Clear")
         clear_button.clicked.connect(self.clear_screen)
 
         hbox_bottom.addStretch(7)
-        hbox_bottom.addWidget(run_button)
+        hbox_bottom.addWidget(self.run_button)
+        hbox_bottom.addWidget(self.cancel_button)
         hbox_bottom.addWidget(clear_button)
 
         layout.addLayout(hbox_bottom, 11,0,1,9)
@@ -509,10 +649,11 @@ class APDMWindow(ProcessingWindow):
         rc_tempname = QFileDialog.getOpenFileName(self,
                 "Open File",
                 basedir,
-                "CSV files (*.csv)")
+                "REDCap files (*.csv *.parquet *.feather)")
         if rc_tempname[0]:
             self.rc_filename = rc_tempname[0]
-            self.redcap = pd.read_csv(self.rc_filename)
+            # don/doff times are parsed once here, for every row
+            self.redcap = redcap.RedcapIndex.read(self.rc_filename)
             self.rc_loaded.setText(rc_tempname[0])
         else:
             return
@@ -526,15 +667,32 @@ class APDMWindow(ProcessingWindow):
         if h5_tempname[0]:
             self.h5_filename = h5_tempname[0]
             self.h5_loaded.setText(h5_tempname[0])
+            self.show_h5_info()
+
+    def show_h5_info(self):
+        """ sensors and time range of the h5 file, from the metadata index
+
+        Also fills in the right label when it is empty and one sensor's
+        label names the right side.
+        """
+        index = h5index.default_index()
+        try:
+            entry = index.entry(self.h5_filename)
+        except (OSError, KeyError) as err:
+            self.statusBar().showMessage(
+                    f"Could not read the sensors of the h5 file: {err}")
+            return
+        index.save()
+        right = h5index.right_label(entry)
+        if right is not None and not self.label_r.text().strip():
+            self.label_r.setText(right)
+        self.statusBar().showMessage(h5index.describe(entry))
 
     def sensor_specific_housekeeping(self):
-        in_en_dt = apdm.make_start_end_datetime(self.redcap,
+        return pipeline.OpalJob(self.redcap,
                 self.h5_filename,
-                self.timezone.currentText())
-        SUBJECT = apdm.OpalV2(self.h5_filename,
-                in_en_dt,
+                self.timezone.currentText(),
                 self.label_r.text())
-        return SUBJECT
 
     def clear_screen(self):
         """ clear_screen is a function that clears
@@ -549,6 +707,8 @@ class APDMWindow(ProcessingWindow):
         self.recap = None
         self.rc_filename = ""
         self.h5_filename = ""
+        self.memo = pipeline.StageMemo()
+        self.timings_table.setRowCount(0)
         self.rc_loaded.setText("")
         self.h5_loaded.setText("")
         self.label_r.clear()
@@ -646,19 +806,19 @@ class ConvertWindow(QMainWindow):
         ## load the file as well
         # Try if the user does not load a file at the first go
         if self.fileNames[0]:
-            self.dt = pd.read_csv(self.fileNames[0])
-            cols = self.dt.columns
+            # Only the header; the chosen columns are read in file_convert
+            self.cols = redcap.export_columns(self.fileNames[0])
             # Then fill in the dropdown menus with 
             #   the column names of the original csv file
-            self.id_dropdown.addItems(cols)
-            self.fname_dropdown.addItems(cols)
-            self.donned_dropdown.addItems(cols)
-            self.doffed_dropdown.addItems(cols)
+            for dropdown in [self.id_dropdown, self.fname_dropdown,
+                             self.donned_dropdown, self.doffed_dropdown]:
+                dropdown.clear()
+                dropdown.addItems(self.cols)
         else:
             return
 
     def file_convert(self):
-        if hasattr(self, 'dt'):
+        if hasattr(self, 'cols'):
             # Columns Of InterestS (cois)
             # Currently, the order should be:
             #   [id, filename, time donned, time doffed]
@@ -666,25 +826,41 @@ class ConvertWindow(QMainWindow):
                     self.fname_dropdown.currentText(),
                     self.donned_dropdown.currentText(),
                     self.doffed_dropdown.currentText()]
-            # Get the subset
-            temp = self.dt.loc[:, cois]
-            # change the column names to what we want
-            out = temp.rename(columns={cois[0]: 'id',
-                                       cois[1]: 'filename',
-                                       cois[2]: 'don_t',    # time donned
-                                       cois[3]: 'doff_t'})  # time doffed
 
             # Let the person save the file at the designated location
-            outname = QFileDialog.getSaveFileName(self, 'Save File', filter='*.csv')
+            # csv by default; parquet / feather keep the times as datetimes
+            outname = QFileDialog.getSaveFileName(
+                    self, 'Save File',
+                    filter=';;'.join('*' + x for x in redcap.FORMATS))
             if outname[0] == '':
                 pass
             else:
-                out.to_csv(outname[0], index=False)
+                filename = outname[0]
+                ext = os.path.splitext(filename)[1].lower()
+                if ext not in redcap.FORMATS:
+                    filename += outname[1].lstrip('*') or '.csv'
+                # Read just those, renamed to id, filename,
+                #   don_t (time donned), doff_t (time doffed), and
+                #   written chunk by chunk
+                try:
+                    kept, dropped = redcap.convert_export(
+                            self.fileNames[0], cois, filename)
+                except Exception as err:
+                    # Nothing is left at filename, see convert_export
+                    msg = QMessageBox(self)
+                    msg.setIcon(QMessageBox.Icon.Warning)
+                    msg.setWindowTitle("Important Message")
+                    msg.setText(f"Conversion failed: {type(err).__name__}: "
+                                f"{err}")
+                    msg.exec()
+                    return
 
                 # If things went well, throw out a message
                 msg = QMessageBox(self)
                 msg.setWindowTitle("Important Message")
-                msg.setText("Conversion completed")
+                msg.setText(f"Conversion completed: {kept} rows"
+                            + (f", {dropped} without a filename or "
+                               "time donned left out" if dropped else ""))
                 msg.exec()
         else:
             msg = QMessageBox(self)
@@ -695,6 +871,7 @@ class ConvertWindow(QMainWindow):
 def main():
     app = QApplication(sys.argv)
     win = MainWindow()
+    warm_up(np, cache, instrument, redcap, h5index, pipeline)
     sys.exit(app.exec())
 
 if __name__ == '__main__':
@@ -0,0 +1,421 @@
+""" Headless batch preprocessing
+
+Runs the same sequence as the Run button of the preprocessing window
+(get_mov, cycle_filt, acc_per_mov, time_asleep, hour and rate math)
+for every row of a formatted REDCap file, and writes one table with
+a row per subject. Does not import PyQt6.
+
+Usage
+-----
+    python batch.py formatted_redcap.csv --data-dir /path/to/files \\
+            --timezone America/Los_Angeles --label-r right -o results.csv
+
+The REDCap file is the output of ConvertWindow (id, filename, don_t,
+doff_t), as csv, parquet or feather. For --sensor ax6, each row names
+its left and right .cwa files in filename_l / filename_r columns, or
+as "left.cwa;right.cwa" in filename.
+
+With --jobs N, subjects are spread over N worker processes, each
+optionally capped at --mem-per-worker GB of resident memory (Linux
+only; checked every RSS_POLL seconds, so a short peak can pass).
+Subjects whose worker died, of that cap or otherwise, are retried one
+at a time in a fresh worker, and the output keeps the input order.
+
+Intermediates are cached on disk (see cache.py), so a subject is only
+preprocessed again once its files or settings change; --no-cache turns
+this off.
+
+For --sensor opal, the h5 files under --data-dir are first indexed
+from their metadata (see h5index.py), which resolves every file's
+sides and time range before any worker starts.
+
+--profile FILE.jsonl records the wall and CPU time, peak memory and
+array sizes of every stage (see instrument.py), one JSON line each,
+tagged with the subject's id and filename.
+"""
+import argparse
+import contextlib
+import glob
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+import numpy as np
+import cache
+import h5index
+import instrument
+import pipeline
+from redcap import NAT_US, RedcapIndex, file_key
+
+# A worker is replaced after this many subjects, returning its memory
+TASKS_PER_WORKER = 4
+# Set in every worker process by init_worker: redcap (RedcapIndex), args
+WORKER = {}
+# Seconds between two checks of a worker's resident memory
+RSS_POLL = 0.5
+# Errors of subjects worth another try in a fresh worker
+RETRIED = (BrokenProcessPool, MemoryError)
+# Kept to one thread in every worker, for the pool's lifetime
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def find_file(data_dir, name, ext):
+    """
+    Locate a data file named in the REDCap file
+
+    Parameters
+    ----------
+        data_dir: str
+            directory searched, recursively if needed
+
+        name: str
+            file name as it appears in REDCap, with or without extension
+
+        ext: str
+            expected extension, ex. '.h5'
+
+    Returns
+    -------
+        path: str
+
+    Raises
+    ------
+        FileNotFoundError
+    """
+    name = os.path.basename(str(name).strip())
+    names = [name] if name.endswith(ext) else [name, name + ext]
+    for candidate in names:
+        path = os.path.join(data_dir, candidate)
+        if os.path.isfile(path):
+            return path
+    for candidate in names:
+        found = glob.glob(os.path.join(glob.escape(data_dir), '**',
+                                       glob.escape(candidate)),
+                          recursive=True)
+        if found:
+            return sorted(found)[0]
+    raise FileNotFoundError(f"{name} not found under {data_dir}")
+
+
+def job_row(row, redcap, args):
+    """ the pipeline job of one REDCap row """
+    if args.sensor == 'opal':
+        h5_filename = find_file(args.data_dir, row['filename'], '.h5')
+        return pipeline.OpalJob(redcap, h5_filename,
+                                args.timezone, args.label_r)
+    if 'filename_l' in row and 'filename_r' in row:
+        names = [row['filename_l'], row['filename_r']]
+    else:
+        names = str(row['filename']).split(';')
+    if len(names) != 2:
+        raise ValueError("Expected a left and a right .cwa file, "
+                         f"got {row['filename']!r}")
+    return pipeline.Ax6Job(*(find_file(args.data_dir, x, '.cwa')
+                             for x in names))
+
+
+def run_row(row, redcap, args):
+    """
+    Preprocess one subject
+
+    Returns
+    -------
+        outdict: dict
+            id, filename, pipeline.OUTPUTS and error (None on success);
+            with --profile, also the instrument records of the run
+    """
+    name = row.get('filename')
+    if name is None and 'filename_l' in row:
+        # The Ax6 layout, written as the ';' form of filename
+        name = f"{row['filename_l']};{row.get('filename_r')}"
+    outdict = {'id': row.get('id'), 'filename': name}
+    recorder = instrument.Recorder(enabled=bool(args.profile))
+    try:
+        store = None if args.no_cache else cache.Cache(args.cache_dir)
+        with recorder.stage('total'):
+            outdict.update(pipeline.run_job(job_row(row, redcap, args),
+                                            store=store, recorder=recorder))
+        outdict['error'] = None
+    except Exception as err:
+        if args.verbose:
+            traceback.print_exc()
+        outdict = failed_row(row, err)
+    if args.profile:
+        outdict['profile'] = recorder.records
+    return outdict
+
+
+def failed_row(row, err):
+    """
+    the output row of a subject that could not be processed
+
+    Its 'retry' is True when the worker died or ran out of memory (see
+    run_all); errors of the subject itself would only happen again.
+    """
+    name = row.get('filename')
+    if name is None and 'filename_l' in row:
+        # The Ax6 layout, written as the ';' form of filename
+        name = f"{row['filename_l']};{row.get('filename_r')}"
+    outdict = {'id': row.get('id'), 'filename': name}
+    outdict.update(dict.fromkeys(pipeline.OUTPUTS))
+    outdict['error'] = f"{type(err).__name__}: {err}"
+    outdict['retry'] = isinstance(err, RETRIED)
+    return outdict
+
+
+def init_worker(redcap, args):
+    """ runs once in every worker process """
+    WORKER['redcap'] = redcap
+    WORKER['args'] = args
+    if args.mem_per_worker:
+        if rss_bytes() is None:
+            print("Resident memory cannot be read on this system; "
+                  "--mem-per-worker is not enforced")
+        else:
+            watch_memory(int(args.mem_per_worker * 1024**3))
+
+
+def rss_bytes():
+    """ resident set size of this process, or None where unknown """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def watch_memory(limit):
+    """
+    End this worker once its resident memory passes limit (bytes)
+
+    RLIMIT_AS would count address space instead: the memory maps of
+    h5 and .cwa data and the thread stack reservations, which are not
+    memory in use, and fail workers far below the stated size. The pool
+    then sees the worker die, and run_all retries its subject alone.
+    """
+    def run():
+        while True:
+            rss = rss_bytes()
+            if rss is not None and rss > limit:
+                print(f"Worker {os.getpid()} uses {rss / 1024**3:.1f} GB, "
+                      "over --mem-per-worker; stopping it", flush=True)
+                os._exit(1)
+            time.sleep(RSS_POLL)
+    threading.Thread(target=run, name='watch_memory', daemon=True).start()
+
+
+def run_task(row):
+    """ run_row in a worker process """
+    return run_row(row, WORKER['redcap'], WORKER['args'])
+
+
+def make_pool(jobs, redcap, args):
+    """ a pool of fresh (spawned) worker processes; see worker_env """
+    kwargs = {}
+    if sys.version_info >= (3, 11):
+        kwargs['max_tasks_per_child'] = TASKS_PER_WORKER
+    return ProcessPoolExecutor(max_workers=jobs,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker,
+                               initargs=(redcap, args), **kwargs)
+
+
+@contextlib.contextmanager
+def worker_env():
+    """
+    Keep the numerical libraries of the workers to one thread each
+
+    The variables must be set when a worker starts (they are read as
+    numpy loads), and workers are spawned all along the pool's life, so
+    they are set for that long and then restored.
+    """
+    saved = {var: os.environ.get(var) for var in THREAD_VARS}
+    for var in THREAD_VARS:
+        os.environ.setdefault(var, '1')
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def worker_count(args):
+    """ --jobs, reduced so that the memory budgets fit in RAM """
+    jobs = max(args.jobs, 1)
+    if args.mem_per_worker:
+        try:
+            total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            return jobs
+        fit = max(int(total // (args.mem_per_worker * 1024**3)), 1)
+        if fit < jobs:
+            print(f"Using {fit} workers: {jobs} x {args.mem_per_worker} GB "
+                  "does not fit in memory")
+            jobs = fit
+    return jobs
+
+
+def report(done, total, outdict, stage=''):
+    print(f"[{stage}{done}/{total}] {outdict['filename']}")
+    if outdict['error']:
+        print(f"    failed: {outdict['error']}")
+
+
+def run_all(rows, redcap, args):
+    """
+    Preprocess every row, in parallel if args.jobs > 1
+
+    Returns
+    -------
+        results: list of dict
+            one run_row output per row, in input order
+    """
+    jobs = worker_count(args)
+    if jobs == 1:
+        results = []
+        for row in rows:
+            results.append(run_row(row, redcap, args))
+            report(len(results), len(rows), results[-1])
+        return results
+
+    results = [None] * len(rows)
+    with worker_env(), make_pool(jobs, redcap, args) as pool:
+        futures = {pool.submit(run_task, row): i
+                   for i, row in enumerate(rows)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as err:    # the worker died (ex. out of memory)
+                results[i] = failed_row(rows[i], err)
+            report(done, len(rows), results[i])
+
+    # One subject per fresh worker, so a crash takes nothing else down;
+    # only subjects whose worker died, the others would fail the same way
+    for attempt in range(1, args.retries + 1):
+        retry = [i for i, r in enumerate(results) if r.get('retry')]
+        for done, i in enumerate(retry, 1):
+            print(f"Retrying {results[i]['filename']} on its own")
+            with worker_env(), make_pool(1, redcap, args) as pool:
+                try:
+                    results[i] = pool.submit(run_task, rows[i]).result()
+                except Exception as err:
+                    results[i] = failed_row(rows[i], err)
+            report(done, len(retry), results[i], f'retry {attempt}: ')
+    return results
+
+
+def index_files(redcap, args):
+    """
+    Index the h5 files under --data-dir and check them against REDCap
+
+    Reports, before any worker starts, the files whose sides --label-r
+    does not resolve and the rows whose don/doff times fall outside
+    their recording. The index is kept under --cache-dir; with
+    --no-cache every file is scanned again and nothing is written.
+    """
+    index = h5index.H5Index(None if args.no_cache
+                            else h5index.index_file(args.cache_dir))
+    failed = index.scan(args.data_dir)
+    index.save()
+    folder = os.path.abspath(args.data_dir) + os.sep
+    paths = [x for x in index.entries if x.startswith(folder)]
+    sides = index.sides(args.label_r, paths)
+    unresolved = sum(x is None for x in sides.values())
+    print(f"{len(paths)} h5 files indexed, {len(failed)} unreadable; "
+          f"{args.label_r!r} leaves the sides of {unresolved} unresolved")
+
+    # Time range of every file, by the name REDCap uses for it
+    table = index.table(paths)
+    table['key'] = table['file'].map(file_key)
+    ranges = table.groupby('key').agg(first=('first_us', 'min'),
+                                      last=('last_us', 'max'))
+    keys = redcap.table['filename'].map(file_key)
+    first = keys.map(ranges['first']).to_numpy(float)
+    last = keys.map(ranges['last']).to_numpy(float)
+    outside = np.zeros(len(keys), bool)
+    for us in redcap.localize(args.timezone).values():
+        known = (us != NAT_US) & ~np.isnan(first)
+        outside |= known & ((us < first) | (us > last))
+    if outside.any():
+        print(f"{outside.sum()} rows have don/doff times outside their "
+              "recording")
+
+
+def write_profile(filename, rows):
+    """ the instrument records of every row, as JSON lines """
+    with open(filename, 'w') as f:
+        for row in rows:
+            # Rows of crashed workers have none
+            instrument.write_jsonl(f, row.pop('profile', []),
+                                   id=row['id'], filename=row['filename'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Preprocess many subjects without the GUI")
+    parser.add_argument('redcap',
+                        help="formatted REDCap file, csv, parquet or feather "
+                             "(id, filename, don_t, doff_t)")
+    parser.add_argument('--data-dir', default=os.curdir,
+                        help="directory holding the h5 / cwa files")
+    parser.add_argument('--sensor', choices=['opal', 'ax6'], default='opal')
+    parser.add_argument('--timezone', default='America/Los_Angeles',
+                        help="timezone of the study site")
+    parser.add_argument('--label-r', default='right',
+                        help="label used for the right side identification")
+    parser.add_argument('-o', '--output', default='results.csv')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes")
+    parser.add_argument('--mem-per-worker', type=float, default=None,
+                        help="resident memory limit of each worker, in GB "
+                             "(Linux)")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="times a subject whose worker died is retried "
+                             "on its own (with --jobs > 1)")
+    parser.add_argument('--cache-dir', default=cache.CACHE_DIR,
+                        help="where intermediates and the h5 index are "
+                             "cached")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always preprocess and index from the raw "
+                             "files")
+    parser.add_argument('--profile', metavar='FILE.jsonl', default=None,
+                        help="write the time and memory of every stage, "
+                             "one JSON line per stage")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print tracebacks of failed subjects")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    redcap = RedcapIndex.read(args.redcap)
+    if args.sensor == 'opal':
+        unparsed = sum((us == NAT_US).sum()
+                       for us in redcap.localize(args.timezone).values())
+        if unparsed:
+            print(f"{unparsed} don/doff times could not be parsed "
+                  f"in {args.timezone}")
+        index_files(redcap, args)
+    rows = run_all(redcap.table.to_dict('records'), redcap, args)
+    if args.profile:
+        write_profile(args.profile, rows)
+    out = pd.DataFrame(rows, columns=['id', 'filename'] +
+                       pipeline.OUTPUTS + ['error'])
+    out.to_csv(args.output, index=False)
+    failed = out['error'].notna().sum()
+    print(f"{len(out) - failed} subjects processed, {failed} failed: "
+          f"{args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
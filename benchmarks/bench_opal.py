@@ -0,0 +1,72 @@
+""" OpalCapture: opening, trimming and detrending Opal recordings """
+import pytest
+import pytz
+import recording
+import synthetic
+import testzero
+
+TZ = pytz.timezone(synthetic.TIMEZONE)
+# Width of the graph, in samples shown
+SCREEN_POINTS = 2000
+
+
+def open_capture(path):
+    return testzero.OpalCapture(recording.open_recording(path), stream=True)
+
+
+@pytest.fixture(params=['v1', 'v2'])
+def opal(request, opal_v1, opal_v2):
+    """ path of a synthetic recording """
+    return opal_v1 if request.param == 'v1' else opal_v2
+
+
+@pytest.fixture
+def capture(opal):
+    capture = open_capture(opal)
+    yield capture
+    capture.close()
+
+
+@pytest.mark.benchmark(group='OpalCapture.__init__')
+def bench_init(benchmark, opal):
+    benchmark(lambda: open_capture(opal).close())
+
+
+@pytest.mark.benchmark(group='OpalCapture.update')
+def bench_update(benchmark, capture, in_time, quiet):
+    benchmark(capture.update, in_time, TZ)
+
+
+@pytest.mark.benchmark(group='OpalCapture.get_mag')
+@pytest.mark.parametrize('stream', [True, False])
+def bench_get_mag_offset(benchmark, capture, stream):
+    """ the detrending median of both sides, from a fresh get_mag """
+    sensors = {x: series.acc for x, series in capture.accmags.items()}
+
+    def run():
+        mags = capture.get_mag(sensors, capture.dp_idx, stream=stream)
+        return [x.offset for x in mags.values()]
+    benchmark(run)
+
+
+@pytest.mark.benchmark(group='OpalCapture.get_mag')
+def bench_get_mag_window(benchmark, capture):
+    """ one screen of detrended magnitude, offset already known """
+    series = capture.accmags['LEFT']
+    series.offset
+    middle = len(series) // 2
+    benchmark(series.__getitem__, slice(middle, middle + SCREEN_POINTS))
+
+
+@pytest.mark.benchmark(group='EnvelopePyramid')
+def bench_pyramid_build(benchmark, capture):
+    series = capture.accmags['LEFT']
+    series.offset
+    benchmark(testzero.EnvelopePyramid, series)
+
+
+@pytest.mark.benchmark(group='EnvelopePyramid')
+def bench_envelope_full_view(benchmark, capture):
+    pyramid = capture.pyramid('LEFT')
+    pyramid.envelope(0, pyramid.n, SCREEN_POINTS)
+    benchmark(pyramid.envelope, 0, pyramid.n, SCREEN_POINTS)
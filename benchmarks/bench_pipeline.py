@@ -0,0 +1,101 @@
+""" The preprocessing behind the Run button, and its inputs """
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import cwa
+import redcap
+
+# Rows of the synthetic REDCap export
+EXPORT_ROWS = 20000
+# Instruments (columns) of the export that are not converted
+EXPORT_COLUMNS = 500
+
+
+@pytest.fixture(scope='session')
+def export(data_dir):
+    """ a raw REDCap export, wide like the multi-site ones """
+    path = os.path.join(data_dir, f'export_{EXPORT_ROWS}.csv')
+    if not os.path.exists(path):
+        rng = np.random.default_rng(0)
+        table = pd.DataFrame(rng.integers(0, 5, (EXPORT_ROWS, EXPORT_COLUMNS)),
+                             columns=[f'item_{i}' for i in range(EXPORT_COLUMNS)])
+        table['record_id'] = np.arange(EXPORT_ROWS)
+        table['h5_file'] = [f'{20200101 + i % 28}-{i:06d}.h5'
+                            for i in range(EXPORT_ROWS)]
+        table['time_donned'] = '2020-01-01 10:00'
+        table['time_doffed'] = '2020-01-02 09:00'
+        table.to_csv(path, index=False)
+    return path
+
+
+COIS = ['record_id', 'h5_file', 'time_donned', 'time_doffed']
+
+
+@pytest.mark.benchmark(group='REDCap')
+def bench_export_columns(benchmark, export):
+    benchmark(redcap.export_columns, export)
+
+
+@pytest.mark.benchmark(group='REDCap')
+@pytest.mark.parametrize('ext', ['.csv', '.parquet', '.feather'])
+# One chunk, and four appended to the same writer
+@pytest.mark.parametrize('chunksize', [redcap.CHUNK_ROWS, EXPORT_ROWS // 4])
+def bench_convert_export(benchmark, export, tmp_path, ext, chunksize):
+    benchmark(redcap.convert_export, export, COIS,
+              str(tmp_path / ('formatted' + ext)), chunksize)
+
+
+@pytest.mark.benchmark(group='REDCap')
+@pytest.mark.parametrize('ext', ['.csv', '.parquet', '.feather'])
+def bench_redcap_read(benchmark, export, tmp_path, ext):
+    out = str(tmp_path / ('formatted' + ext))
+    redcap.convert_export(export, COIS, out, EXPORT_ROWS // 4)
+    index = benchmark(redcap.RedcapIndex.read, out)
+    assert len(index) == EXPORT_ROWS
+
+
+@pytest.mark.benchmark(group='REDCap')
+def bench_redcap_index(benchmark, export):
+    table = redcap.read_export(export, COIS)
+
+    def run():
+        index = redcap.RedcapIndex(table)
+        index.localize('America/Los_Angeles')
+        return index
+    benchmark(run)
+
+
+@pytest.mark.benchmark(group='cwa')
+def bench_cwa_convert(benchmark, cwa_file, tmp_path):
+    benchmark(cwa.convert, cwa_file, str(tmp_path / 'decoded.bin'))
+
+
+@pytest.mark.benchmark(group='run_preprocess')
+def bench_run_preprocess(benchmark, opal_v2, tmp_path):
+    """ the stage sequence (load through time_asleep), without caches """
+    pytest.importorskip('apdm')
+    import pipeline
+    table = pd.DataFrame({'id': [1],
+                          'filename': [os.path.basename(opal_v2)],
+                          'don_t': ['2020-01-01 10:00'],
+                          'doff_t': ['2020-01-01 23:00']})
+    job = pipeline.OpalJob(table, opal_v2, 'America/Los_Angeles', 'right')
+    benchmark.pedantic(pipeline.run_job, (job,), rounds=3)
+
+
+@pytest.mark.benchmark(group='intermediates')
+@pytest.mark.parametrize('parallel', [False, True],
+                         ids=['serial', 'parallel'])
+def bench_intermediates(benchmark, opal_v2, parallel):
+    """ both sides' chains, one after the other or on two threads """
+    pytest.importorskip('apdm')
+    import pipeline
+    table = pd.DataFrame({'id': [1],
+                          'filename': [os.path.basename(opal_v2)],
+                          'don_t': ['2020-01-01 10:00'],
+                          'doff_t': ['2020-01-01 23:00']})
+    subject = pipeline.load_opal(table, opal_v2, 'America/Los_Angeles',
+                                 'right')
+    benchmark.pedantic(pipeline.intermediates, (subject,),
+                       {'parallel': parallel}, rounds=3)
@@ -0,0 +1,65 @@
+""" testzero.MainWindow: stepping through the video and aligning the graph """
+import pytest
+import testzero
+import synthetic
+from bench_opal import open_capture
+
+# Frames moved per step, as with the viewer's buttons
+STEPS = [1, 1, 1, 5, 10, -1, -10]
+
+
+@pytest.fixture
+def window(qapp, quiet):
+    window = testzero.MainWindow()
+    window.show()
+    qapp.processEvents()
+    yield window
+    if window.capture is not None:
+        window.capture.deleteLater()
+    if window.sensorcapture is not None:
+        window.sensorcapture.close()
+    window.close()
+
+
+@pytest.fixture
+def capture(window, video, qapp):
+    window.capture = testzero.VideoCapture(video, window.videoDisplayWidget)
+    window.capture.frameChanged.connect(window.moveCursor)
+    qapp.processEvents()
+    return window.capture
+
+
+@pytest.mark.benchmark(group='VideoCapture.nextFrameSlot')
+@pytest.mark.parametrize('pattern', ['forward', 'mixed'])
+def bench_next_frame(benchmark, capture, qapp, pattern):
+    """ one step, cycling through the video (read-ahead on) """
+    steps = [1] if pattern == 'forward' else STEPS
+    state = {'i': 0}
+
+    def step():
+        count = steps[state['i'] % len(steps)]
+        state['i'] += 1
+        if not 0 <= capture.frameNumber + count < capture.numFrames:
+            count = -capture.frameNumber
+        capture.nextFrameSlot(count)
+        qapp.processEvents()
+    benchmark(step)
+
+
+@pytest.mark.benchmark(group='MainWindow.lockTime')
+def bench_lock_time(benchmark, window, capture, opal_v2, in_time, qapp):
+    """ trim the sensor data to the video and plot both sides """
+    window.sensorcapture = open_capture(opal_v2)
+    window.videoCapturePoint.setText('1')
+    window.sensorCaptureDate.setText('{:04d}/{:02d}/{:02d}'.format(*in_time))
+    window.sensorCapturePoint.setText('{:02d}:{:02d}:{:02d}'
+                                      .format(*in_time[3:]))
+    window.timezone.setCurrentText(synthetic.TIMEZONE)
+
+    def lock():
+        window.lockTime()
+        qapp.processEvents()
+        window.lockTime(reverse=True)
+    benchmark(lock)
+    # lockTime reports its failures by printing only
+    assert window.plotStart is not None
@@ -0,0 +1,100 @@
+""" Synthetic data and Qt fixtures shared by the benchmarks """
+import contextlib
+import io
+import os
+import sys
+from datetime import datetime
+import pytest
+import pytz
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('incwear benchmarks')
+    group.addoption('--hours', type=float, default=1.0,
+                    help="length of the synthetic sensor recordings")
+    group.addoption('--video-seconds', type=float, default=60.0,
+                    help="length of the synthetic video")
+    group.addoption('--data-dir', default=None,
+                    help="keep the synthetic files here between runs "
+                         "(default: a temporary directory)")
+
+
+@pytest.fixture(scope='session')
+def data_dir(request, tmp_path_factory):
+    path = request.config.getoption('--data-dir')
+    if path is None:
+        return str(tmp_path_factory.mktemp('synthetic'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def generated(data_dir, name, make, *args, **kwargs):
+    """ data_dir/name, written by make(path, ...) unless already there """
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        # Keep the extension, it picks the video container
+        stem, ext = os.path.splitext(path)
+        make(stem + '.tmp' + ext, *args, **kwargs)
+        os.replace(stem + '.tmp' + ext, path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def hours(request):
+    return request.config.getoption('--hours')
+
+
+@pytest.fixture(scope='session')
+def in_time(hours):
+    """ [YYYY, MM, DD, HH, mm, SS] in synthetic.TIMEZONE, halfway into
+    the recordings of --hours """
+    t = datetime.fromtimestamp(synthetic.START_US // 10**6 +
+                               int(hours * 1800),
+                               pytz.timezone(synthetic.TIMEZONE))
+    return [t.year, t.month, t.day, t.hour, t.minute, t.second]
+
+
+@pytest.fixture(scope='session')
+def opal_v1(data_dir, hours):
+    return generated(data_dir, f'opal_v1_{hours:g}h.h5', synthetic.make_opal,
+                     hours, v2=False)
+
+
+@pytest.fixture(scope='session')
+def opal_v2(data_dir, hours):
+    return generated(data_dir, f'opal_v2_{hours:g}h.h5', synthetic.make_opal,
+                     hours, v2=True)
+
+
+@pytest.fixture(scope='session')
+def cwa_file(data_dir, hours):
+    return generated(data_dir, f'ax6_{hours:g}h.cwa', synthetic.make_cwa,
+                     hours)
+
+
+@pytest.fixture(scope='session')
+def video(request, data_dir):
+    seconds = request.config.getoption('--video-seconds')
+    return generated(data_dir, f'clip_{seconds:g}s.mp4',
+                     synthetic.make_video, seconds)
+
+
+@pytest.fixture(scope='session')
+def qapp():
+    """ the QApplication, offscreen when there is no display """
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def quiet():
+    """ silence the prints of the code under test """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
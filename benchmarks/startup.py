@@ -0,0 +1,100 @@
+""" Startup benchmark of the GUIs
+
+Starts app.py's or testzero.py's main window in a fresh interpreter
+(python -X importtime) and reports the time to the first window and
+the import time of the slowest modules.
+
+Usage
+-----
+    python benchmarks/startup.py [--gui app|testzero] [--repeat 5]
+
+Without a display, Qt's offscreen platform is used.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Run in the child; prints the seconds from its first line to a shown window
+CHILD = """
+import time
+start = time.perf_counter()
+import sys
+sys.path.insert(0, {root!r})
+from PyQt6.QtWidgets import QApplication
+app = QApplication(sys.argv)
+import {gui} as gui
+window = gui.MainWindow()
+window.show()
+app.processEvents()
+print('first_window', time.perf_counter() - start)
+"""
+IMPORT_LINE = re.compile(r'import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)')
+
+
+def run_once(gui):
+    """
+    Returns
+    -------
+        (wall, first_window, imports)
+            seconds from spawning the interpreter to the window, seconds
+            from its first line to the window, and {module: (self,
+            cumulative) import time in s} of the modules imported by
+            the child and by the modules it imports directly
+    """
+    env = dict(os.environ)
+    if sys.platform.startswith('linux') and not env.get('DISPLAY'):
+        env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    start = time.perf_counter()
+    proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             CHILD.format(root=ROOT, gui=gui)],
+            capture_output=True, text=True, env=env, cwd=ROOT)
+    wall = time.perf_counter() - start
+    out = [x for x in proc.stdout.splitlines() if x.startswith('first_window')]
+    if proc.returncode or not out:
+        raise RuntimeError(f"{gui} did not start:\n{proc.stderr[-2000:]}")
+
+    imports = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        # Indented by 1 + 2 per level of nesting
+        if match and len(match.group(3)) <= 3:
+            imports[match.group(4)] = (int(match.group(1)) / 1e6,
+                                       int(match.group(2)) / 1e6)
+    return wall, float(out[-1].split()[1]), imports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--gui', choices=['app', 'testzero'], default='app')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help="modules listed, slowest first")
+    args = parser.parse_args(argv)
+
+    runs = [run_once(args.gui) for _ in range(args.repeat)]
+    walls, firsts = [x[0] for x in runs], [x[1] for x in runs]
+    print(f"{args.gui}: {args.repeat} runs (median, min)")
+    print(f"  process start to first window: "
+          f"{statistics.median(walls):.3f} s, {min(walls):.3f} s")
+    print(f"  first line to first window:    "
+          f"{statistics.median(firsts):.3f} s, {min(firsts):.3f} s")
+
+    # Median cumulative import time of every module seen in the runs
+    names = {name for _, _, imports in runs for name in imports}
+    cumulative = {name: statistics.median(imports.get(name, (0, 0))[1]
+                                          for _, _, imports in runs)
+                  for name in names}
+    print("  imports before the first window (cumulative, median):")
+    for name in sorted(cumulative, key=cumulative.get,
+                       reverse=True)[:args.top]:
+        print(f"    {name:<32}{cumulative[name] * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+""" Synthetic recordings for the benchmarks
+
+Nothing here comes from a participant: the signals are noise around
+gravity with occasional bursts, laid out like the real files.
+
+Usage
+-----
+    python benchmarks/synthetic.py opal2 out.h5 --hours 24
+    python benchmarks/synthetic.py cwa out.cwa --hours 168
+    python benchmarks/synthetic.py video out.mp4 --seconds 600
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import cwa
+
+# 2020-01-01 18:00 UTC, 10:00 in TIMEZONE
+START_US = 1577901600000000
+TIMEZONE = 'America/Los_Angeles'
+OPAL_RATE = 128
+# Rows generated and written at a time
+BLOCK = 1 << 20
+# Opal V2 sensor ids and labels (left, right)
+SENSORS = [('XI-000001', 'Left Leg'), ('XI-000002', 'Right Leg')]
+
+
+def accel_block(rng, n):
+    """ n x 3 accelerations (m/s^2): noise, gravity, a few bursts """
+    acc = rng.normal(0, 0.05, (n, 3)).astype(np.float32)
+    acc[:, 2] += 9.81
+    starts = rng.integers(0, max(n - 64, 1), max(n // 2000, 1))
+    for start in starts:
+        acc[start:start + 64] += rng.normal(0, 3, (1, 3)).astype(np.float32)
+    return acc
+
+
+def make_opal(path, hours=1.0, v2=True, rate=OPAL_RATE, seed=0):
+    """
+    An APDM Opal recording of both legs
+
+    V2 keeps each sensor under Sensors/<id> with its 'Label 0'; V1 keeps
+    them at the root, named by the MonitorLabelList / CaseIdList
+    attributes. Datasets are chunked like the real files.
+    """
+    import h5py
+    n = int(hours * 3600 * rate)
+    step_us = int(round(1e6 / rate))
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, 'w') as f:
+        if v2:
+            groups = []
+            for sid, label in SENSORS:
+                group = f.create_group(f'Sensors/{sid}')
+                group.create_group('Configuration').attrs['Label 0'] = \
+                    np.bytes_(label)
+                groups.append((group, 'Accelerometer'))
+        else:
+            f.attrs['MonitorLabelList'] = np.array([b'LEFT', b'RIGHT'])
+            f.attrs['CaseIdList'] = np.array([b'SI-000001', b'SI-000002'])
+            groups = [(f.create_group(x), 'Calibrated/Accelerometers')
+                      for x in ['SI-000001', 'SI-000002']]
+        for group, acc_name in groups:
+            time = group.create_dataset('Time', (n,), np.uint64,
+                                        chunks=(min(n, 1 << 14),))
+            acc = group.create_dataset(acc_name, (n, 3), np.float32,
+                                       chunks=(min(n, 1 << 14), 3))
+            for start in range(0, n, BLOCK):
+                stop = min(start + BLOCK, n)
+                time[start:stop] = START_US + np.arange(start, stop,
+                                                        dtype=np.uint64) * step_us
+                acc[start:stop] = accel_block(rng, stop - start)
+    return path
+
+
+def make_cwa(path, hours=1.0, rate_code=0x0a, seed=0):
+    """ An Axivity Ax6 .cwa file (100 Hz, 6 axes, 16 bit, 40 per sector) """
+    per_sector = 40
+    rate = 3200 / (1 << (15 - rate_code))
+    total = int(hours * 3600 * rate) // per_sector
+    rng = np.random.default_rng(seed)
+    t0 = START_US / 1e6
+    with open(path, 'wb') as f:
+        # Metadata header ('MD'), not decoded by cwa.py
+        header = np.zeros(1024, np.uint8)
+        header[:2] = [0x4d, 0x44]
+        f.write(header.tobytes())
+        for first in range(0, total, BLOCK // per_sector):
+            n = min(BLOCK // per_sector, total - first)
+            index = np.arange(first, first + n)
+            sectors = np.zeros(n, cwa.SECTOR)
+            sectors['header'] = cwa.DATA_HEADER
+            sectors['length'] = cwa.DATA_LENGTH
+            sectors['sequence'] = index
+            sectors['count'] = per_sector
+            sectors['axes_bps'] = 0x62
+            sectors['rate'] = rate_code | 0x80
+            # 8 g (4096 per g), 2000 deg/s
+            sectors['light'] = (4 << 13) | (2 << 10)
+            # Whole-second timestamp of the first sample at or after
+            # the sector start, and that sample's position
+            start = t0 + index * per_sector / rate
+            whole = np.ceil(start).astype(np.int64)
+            sectors['offset'] = np.round((whole - start) * rate)
+            sectors['timestamp'] = pack_timestamps(whole)
+            acc = accel_block(rng, n * per_sector) / 9.81 * 4096
+            gyro = rng.normal(0, 200, (n * per_sector, 3))
+            values = np.hstack([gyro, acc]).clip(-32768, 32767)
+            sectors['data'] = values.astype('<i2').reshape(n, -1).view(np.uint8)
+            f.write(sectors.tobytes())
+    return path
+
+
+def pack_timestamps(seconds):
+    """ epoch seconds as .cwa packed date-times """
+    t = seconds.astype('M8[s]')
+    year = t.astype('M8[Y]').astype(np.int64) + 1970
+    month = t.astype('M8[M]').astype(np.int64) % 12 + 1
+    day = (t.astype('M8[D]') - t.astype('M8[M]')).astype(np.int64) + 1
+    sec = (t - t.astype('M8[D]')).astype(np.int64)
+    return (((year - 2000) << 26) | (month << 22) | (day << 17) |
+            (sec // 3600 << 12) | (sec // 60 % 60 << 6) |
+            (sec % 60)).astype(np.uint32)
+
+
+def make_video(path, seconds=60.0, fps=30, size=(1280, 720)):
+    """
+    A clip with the frame number drawn on every frame
+
+    H.264 through the ffmpeg command when it is installed, otherwise
+    whatever OpenCV can write (H.264, else MPEG-4 part 2).
+    """
+    import cv2
+    frames = int(seconds * fps)
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        proc = subprocess.Popen(
+                [ffmpeg, '-loglevel', 'error', '-y', '-f', 'rawvideo',
+                 '-pix_fmt', 'bgr24', '-s', f'{size[0]}x{size[1]}',
+                 '-r', str(fps), '-i', '-', '-c:v', 'libx264',
+                 '-pix_fmt', 'yuv420p', path], stdin=subprocess.PIPE)
+        write = lambda frame: proc.stdin.write(frame.tobytes())
+
+        def close():
+            proc.stdin.close()
+            proc.wait()
+    else:
+        for codec in ['avc1', 'mp4v']:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec),
+                                     fps, size)
+            if writer.isOpened():
+                break
+        if codec != 'avc1':
+            print(f"No H.264 encoder; writing {path} as {codec}")
+        write = lambda frame: writer.write(frame)
+        close = writer.release
+    for i in range(frames):
+        frame = np.full((size[1], size[0], 3), i % 256, np.uint8)
+        cv2.putText(frame, str(i), (50, size[1] // 2),
+                    cv2.FONT_HERSHEY_SIMPLEX, 4, (255, 255, 255), 8)
+        write(frame)
+    close()
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic recording")
+    parser.add_argument('kind', choices=['opal1', 'opal2', 'cwa', 'video'])
+    parser.add_argument('path')
+    parser.add_argument('--hours', type=float, default=1.0)
+    parser.add_argument('--seconds', type=float, default=60.0)
+    args = parser.parse_args(argv)
+    if args.kind == 'video':
+        make_video(args.path, args.seconds)
+    elif args.kind == 'cwa':
+        make_cwa(args.path, args.hours)
+    else:
+        make_opal(args.path, args.hours, v2=args.kind == 'opal2')
+
+
+if __name__ == '__main__':
+    main()
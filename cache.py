@@ -0,0 +1,161 @@
+""" Content-addressed on-disk cache of preprocessing intermediates
+
+An entry is a directory of .npy arrays plus a meta.json, named after a
+hash of everything that went into it (input file contents, REDCap row,
+timezone, labels, algorithm parameters). Entries are evicted least
+recently used first once the cache grows past its size limit.
+
+The location and the limit can be set with the INCWEAR_CACHE and
+INCWEAR_CACHE_MB environment variables.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+        'INCWEAR_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'incwear'))
+MAX_BYTES = int(os.environ.get('INCWEAR_CACHE_MB', 2048)) * 1024**2
+# Bytes read at a time while hashing a file
+HASH_BLOCK = 1 << 20
+
+
+def file_digest(path, root=CACHE_DIR):
+    """
+    blake2b digest of a file's content
+
+    Digests are remembered by (path, size, mtime) in <root>/digests.json,
+    so a file is only read again once it changes.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    memo_path = os.path.join(root, 'digests.json')
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        memo = {}
+    if memo.get(path, [None])[:2] == stamp:
+        return memo[path][2]
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    memo[path] = stamp + [h.hexdigest()]
+    _write_json(memo_path, memo)
+    return memo[path][2]
+
+
+def make_key(files, root=CACHE_DIR, **params):
+    """
+    the cache key of a computation
+
+    Parameters
+    ----------
+        files: list of str
+            input files, identified by content
+
+        params:
+            anything else the result depends on (JSON-serializable,
+            or converted with str)
+
+    Returns
+    -------
+        key: str
+    """
+    desc = {'files': [file_digest(x, root) for x in files], 'params': params}
+    text = json.dumps(desc, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _write_json(path, obj):
+    """ replace path atomically, so readers never see half a file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+class Cache:
+    """ size-bounded LRU store of named arrays
+
+    Parameters
+    ----------
+        root: str
+            cache directory
+
+        max_bytes: int
+            total size kept after every put
+    """
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.root = root
+        self.entries = os.path.join(root, 'entries')
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        """
+        Returns
+        -------
+            (arrays, meta): (dict, dict), or None if key is not cached
+        """
+        entry = os.path.join(self.entries, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            arrays = {name: np.load(os.path.join(entry, name + '.npy'))
+                      for name in meta.pop('arrays')}
+        except (OSError, ValueError, KeyError):
+            return None
+        # Most recently used = most recently touched
+        os.utime(os.path.join(entry, 'meta.json'))
+        return arrays, meta
+
+    def put(self, key, arrays, meta=None):
+        """
+        Parameters
+        ----------
+            arrays: dict
+                {name: np.ndarray}
+
+            meta: dict
+                small JSON-serializable values stored alongside
+        """
+        os.makedirs(self.entries, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.entries, prefix='.tmp')
+        try:
+            for name, arr in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+            meta = dict(meta or {}, arrays=list(arrays))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f, default=float)
+            os.replace(tmp, os.path.join(self.entries, key))
+        except OSError:
+            # Another process stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """ drop least recently used entries until under max_bytes """
+        sizes, used = {}, {}
+        for key in os.listdir(self.entries):
+            entry = os.path.join(self.entries, key)
+            if key.startswith('.'):
+                continue
+            try:
+                files = [os.path.join(entry, x) for x in os.listdir(entry)]
+                sizes[key] = sum(os.path.getsize(x) for x in files)
+                used[key] = os.path.getmtime(os.path.join(entry, 'meta.json'))
+            except OSError:
+                continue
+        total = sum(sizes.values())
+        for key in sorted(used, key=used.get):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.entries, key), ignore_errors=True)
+            total -= sizes[key]
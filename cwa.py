@@ -0,0 +1,271 @@
+""" Axivity .cwa decoding into memory-mapped sample files
+
+A .cwa file is a metadata header followed by independent 512-byte data
+sectors, each holding up to 40 six-axis (or 80 three-axis) samples and
+the timestamp of one of them. read() decodes a file once into a flat
+array of SAMPLE records under <cache dir>/cwa, and maps that array on
+later calls, as long as the source file keeps its size and mtime.
+
+The samples are read through recording.Ax6Recording; pipeline.Ax6Job
+still loads .cwa files with axivity.Ax6, which decodes them itself.
+
+Usage
+-----
+    python cwa.py left.cwa right.cwa
+"""
+import hashlib
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cache
+
+# A data sector, see the OpenMovement AX3/AX6 file format
+SECTOR = np.dtype([('header', '<u2'), ('length', '<u2'),
+                   ('fractional', '<u2'), ('session', '<u4'),
+                   ('sequence', '<u4'), ('timestamp', '<u4'),
+                   ('light', '<u2'), ('temperature', '<u2'),
+                   ('events', 'u1'), ('battery', 'u1'), ('rate', 'u1'),
+                   ('axes_bps', 'u1'), ('offset', '<i2'), ('count', '<u2'),
+                   ('data', 'u1', (480,)), ('checksum', '<u2')])
+# 'AX' and the length of the rest of the sector
+DATA_HEADER = 0x5841
+DATA_LENGTH = 508
+# One decoded sample: device time (s since 1970, no timezone),
+# acceleration (g) and angular velocity (deg/s, NaN without a gyroscope)
+SAMPLE = np.dtype([('time', '<f8'), ('acc', '<f4', (3,)),
+                   ('gyro', '<f4', (3,))])
+# Header of a decoded file: magic, source size, source mtime (ns),
+# number of samples, sample rate (Hz); SAMPLE records follow at
+# HEADER_BYTES
+MAGIC = b'INCWCWA1'
+HEADER = struct.Struct('<8sQqQd')
+HEADER_BYTES = 64
+# Sectors decoded at a time, by one thread
+CHUNK_SECTORS = 1 << 14
+
+
+def read(path, cache_dir=os.path.join(cache.CACHE_DIR, 'cwa')):
+    """
+    Samples of a .cwa file, decoded on first use
+
+    Parameters
+    ----------
+        path: str
+            .cwa file
+
+        cache_dir: str
+            where decoded files are kept
+
+    Returns
+    -------
+        samples: np.memmap
+            read-only SAMPLE records
+
+        rate: float
+            sample rate (Hz) set on the device
+    """
+    stat = os.stat(path)
+    name = hashlib.blake2b(os.path.abspath(path).encode(),
+                           digest_size=16).hexdigest()
+    out = os.path.join(cache_dir, name + '.bin')
+    header = read_header(out)
+    if header is None or header[1:3] != (stat.st_size, stat.st_mtime_ns):
+        convert(path, out)
+        header = read_header(out)
+    _, _, _, count, rate = header
+    if not count:
+        return np.zeros(0, SAMPLE), rate
+    return np.memmap(out, SAMPLE, 'r', HEADER_BYTES, (count,)), rate
+
+
+def read_header(out):
+    """ the HEADER fields of a decoded file, or None if it is not one """
+    try:
+        with open(out, 'rb') as f:
+            fields = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    return fields if fields[0] == MAGIC else None
+
+
+def convert(path, out, workers=None):
+    """
+    decode the .cwa file path into out (see read)
+
+    Sectors are independent, so runs of CHUNK_SECTORS are decoded on
+    a pool of threads (NumPy releases the GIL), each into its own slice
+    of the output; the sample times come from the anchors of the whole
+    file, so the pieces line up. This is the viewer's first open of a
+    file; axivity.Ax6 in the preprocessing keeps its own decoder.
+
+    Parameters
+    ----------
+        workers: int or None
+            number of threads, default os.cpu_count()
+    """
+    stat = os.stat(path)
+    sectors = data_sectors(path)
+    times = sector_times(sectors)
+    rate = sample_rate(sectors)
+
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    tmp = out + '.tmp'
+    count = int(times[2][-1]) if len(sectors) else 0
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime_ns,
+                            count, rate).ljust(HEADER_BYTES, b'\0'))
+        f.truncate(HEADER_BYTES + count * SAMPLE.itemsize)
+    if count:
+        samples = np.memmap(tmp, SAMPLE, 'r+', HEADER_BYTES, (count,))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(decode, sectors[x:x + CHUNK_SECTORS], x,
+                                   times, rate, samples)
+                       for x in range(0, len(sectors), CHUNK_SECTORS)]
+            for future in futures:
+                future.result()
+        samples.flush()
+        del samples
+    os.replace(tmp, out)
+
+
+def data_sectors(path):
+    """ the data sectors of a .cwa file, mapped (not read) as SECTOR """
+    size = os.path.getsize(path) // SECTOR.itemsize
+    if size == 0:
+        return np.zeros(0, SECTOR)
+    sectors = np.memmap(path, SECTOR, 'r', 0, (size,))
+    keep = ((sectors['header'] == DATA_HEADER) &
+            (sectors['length'] == DATA_LENGTH) & (sectors['count'] > 0))
+    if keep.all():
+        return sectors
+    # Only the metadata sectors at the start are usually dropped
+    first = int(np.argmax(keep))
+    if keep[first:].all():
+        return sectors[first:]
+    return sectors[keep]
+
+
+def sector_times(sectors):
+    """
+    Anchors for sample times
+
+    Returns
+    -------
+        (index, time, end): 1-D arrays
+            a sample index and its time (s) per sector, and the index
+            where each sector's samples end
+    """
+    ts = sectors['timestamp'].astype(np.int64)
+    year = (ts >> 26 & 0x3f) + 2000
+    month, day = ts >> 22 & 0x0f, ts >> 17 & 0x1f
+    days = ((year - 1970).astype('M8[Y]').astype('M8[M]') +
+            (month - 1).astype('m8[M]')).astype('M8[D]') + \
+        (day - 1).astype('m8[D]')
+    seconds = (days.astype(np.int64) * 86400 + (ts >> 12 & 0x1f) * 3600 +
+               (ts >> 6 & 0x3f) * 60 + (ts & 0x3f))
+
+    count = sample_counts(sectors)
+    end = np.cumsum(count)
+    index = (end - count + sectors['offset']).astype(np.float64)
+    # A fractional timestamp moves the sample the whole second refers to,
+    # as in the OpenMovement reader
+    fractional = sectors['fractional'].astype(np.int64)
+    has_frac = (fractional & 0x8000) != 0
+    index += np.where(has_frac, ((fractional & 0x7fff) << 1) / 65536, 0) * \
+        sector_rates(sectors)
+    return index, seconds.astype(np.float64), end
+
+
+def sample_counts(sectors):
+    """ samples in every sector, capped at what its data can hold """
+    axes = np.maximum(sectors['axes_bps'].astype(np.int64) >> 4, 1)
+    return np.minimum(sectors['count'].astype(np.int64), 480 // (2 * axes))
+
+
+def sector_rates(sectors):
+    """ sample rate (Hz) of every sector """
+    return 3200 / (1 << (15 - (sectors['rate'].astype(np.int64) & 0x0f)))
+
+
+def sample_rate(sectors):
+    if len(sectors) == 0:
+        return 0.0
+    return float(sector_rates(sectors[:1])[0])
+
+
+def decode(sectors, start, times, rate, samples):
+    """
+    Decode a run of sectors into their slice of samples
+
+    Parameters
+    ----------
+        sectors: np.ndarray
+            consecutive SECTOR records, a slice of data_sectors()
+
+        start: int
+            position of sectors[0] among data_sectors()
+
+        times: tuple
+            sector_times() of all the data sectors
+
+        rate: float
+            sample rate (Hz), for samples outside the first and last anchors
+
+        samples: np.ndarray
+            SAMPLE records of the whole file
+    """
+    if len(sectors) == 0:
+        return
+    axes_bps = sectors['axes_bps']
+    if (axes_bps != axes_bps[0]).any():
+        raise ValueError("Sectors with different axis configurations")
+    axes, bps = int(axes_bps[0]) >> 4, int(axes_bps[0]) & 0x0f
+    if bps != 2 or axes not in (3, 6):
+        raise ValueError("Only unpacked 16-bit 3- or 6-axis data is supported")
+
+    per_sector = 480 // (2 * axes)
+    raw = np.ascontiguousarray(sectors['data'][:, :per_sector * 2 * axes])
+    raw = raw.view('<i2').reshape(len(sectors), per_sector, axes)
+    count = sample_counts(sectors)
+    values = raw[np.arange(per_sector) < count[:, None]].astype(np.float32)
+
+    # Units per g and per deg/s, repeated for every sample
+    light = sectors['light'].astype(np.int64)
+    acc_unit = np.repeat(1 << (8 + (light >> 13 & 0x07)), count)
+    code = light >> 10 & 0x07
+    gyro_range = np.where(code > 0, 8000 >> code, 2000)
+    gyro_scale = np.repeat(gyro_range / 32768, count)
+
+    stop = int(times[2][start + len(sectors) - 1])
+    out = samples[stop - len(values):stop]
+    if axes == 6:
+        out['gyro'] = values[:, :3] * gyro_scale[:, None]
+        out['acc'] = values[:, 3:] / acc_unit[:, None]
+    else:
+        out['gyro'] = np.nan
+        out['acc'] = values / acc_unit[:, None]
+    out['time'] = sample_times(np.arange(stop - len(values), stop),
+                               times, rate)
+
+
+def sample_times(index, times, rate):
+    """ time of each sample index, interpolated between sector anchors """
+    anchor, seconds, _ = times
+    t = np.interp(index, anchor, seconds)
+    # Past the first and last anchors, at the nominal rate
+    for out, i in [(index < anchor[0], 0), (index > anchor[-1], -1)]:
+        t[out] = seconds[i] + (index[out] - anchor[i]) / rate
+    return t
+
+
+def main(argv=None):
+    for path in (sys.argv[1:] if argv is None else argv):
+        samples, rate = read(path)
+        hours = len(samples) / rate / 3600 if rate else 0
+        print(f"{path}: {len(samples)} samples, {rate:g} Hz, {hours:.1f} h")
+
+
+if __name__ == '__main__':
+    main()
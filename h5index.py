@@ -0,0 +1,274 @@
+""" Index of the sensors in Opal h5 files, from their metadata
+
+scan() walks a directory once and opens every h5 file for its metadata
+only: sensor ids, labels and sample rates from the attributes, the
+sample count from the shape of the 'Time' dataset, and its first and
+last values (two single-element reads, as Opal files carry no time
+range attribute). No sample data is read. Entries are kept in
+<cache dir>/h5index.json with the file's size and mtime, so a file is
+opened again only once it changes.
+
+Sides are then resolved for every file at once (see H5Index.sides),
+with the same rule as recording.find_right.
+
+Usage
+-----
+    python h5index.py /path/to/files [--label-r right]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import cache
+import recording
+
+# Name of the index file in a cache directory, and the default one
+INDEX_NAME = 'h5index.json'
+INDEX_FILE = os.path.join(cache.CACHE_DIR, INDEX_NAME)
+# Part of the index file; bump it when the fields of an entry change
+INDEX_VERSION = 1
+# Files scanned, by extension
+EXTENSIONS = ('.h5', '.hdf5')
+# Fields of every sensor of an entry, and the columns of H5Index.table
+SENSOR_FIELDS = ['sensor', 'label', 'sample_rate', 'first_us', 'last_us',
+                 'samples']
+# Attributes holding the sample rate, V2 then V1 naming
+RATE_ATTRS = ['Sample Rate', 'SampleRate']
+
+
+def index_file(cache_dir=cache.CACHE_DIR):
+    """ where the index is kept in cache_dir """
+    return os.path.join(cache_dir, INDEX_NAME)
+
+
+def scan_file(path):
+    """
+    The metadata of one Opal h5 file
+
+    Returns
+    -------
+        entry: dict
+            opal: 1 or 2
+            sensors: list of dict with SENSOR_FIELDS, in file order;
+                sample_rate from the attributes, else from the times
+    """
+    import h5py
+    with h5py.File(path, 'r') as f:
+        is_v2 = 'Sensors' in f
+        sensors = []
+        for sid, label in recording.sensor_labels(f):
+            group = f['Sensors'][sid] if is_v2 else f[sid]
+            time = group['Time']
+            samples = time.shape[0]
+            first, last = ((int(time[0]), int(time[-1])) if samples
+                           else (None, None))
+            rate = sample_rate_attr(f, group)
+            if rate is None and samples > 1 and last > first:
+                rate = (samples - 1) * 1e6 / (last - first)
+            sensors.append(dict(sensor=sid, label=label, sample_rate=rate,
+                                first_us=first, last_us=last,
+                                samples=samples))
+    return {'opal': 2 if is_v2 else 1, 'sensors': sensors}
+
+
+def sample_rate_attr(f, group):
+    """ the sample rate (Hz) stored with a sensor, or None """
+    places = [group.attrs, f.attrs]
+    if 'Configuration' in group:
+        places.insert(0, group['Configuration'].attrs)
+    for attrs in places:
+        for name in RATE_ATTRS:
+            if name in attrs:
+                return float(np.ravel(attrs[name])[0])
+    return None
+
+
+def right_label(entry, words=recording.RIGHT_WORDS):
+    """ the label of the right sensor of an entry, or None """
+    labels = [x['label'] for x in entry['sensors']]
+    right = recording.find_right(labels, words)
+    return None if right is None else labels[right]
+
+
+def describe(entry):
+    """ one line about an entry: sensors, length and start (UTC) """
+    sensors = entry['sensors']
+    text = ', '.join(f"{x['sensor']} ({x['label']})" for x in sensors)
+    firsts = [x['first_us'] for x in sensors if x['first_us'] is not None]
+    lasts = [x['last_us'] for x in sensors if x['last_us'] is not None]
+    if firsts:
+        start = datetime.fromtimestamp(min(firsts) / 1e6, timezone.utc)
+        hours = (max(lasts) - min(firsts)) / 3.6e9
+        text += f"; {hours:.1f} h from {start:%Y-%m-%d %H:%M} UTC"
+    return text
+
+
+class H5Index:
+    """ Metadata of h5 files, kept on disk between runs
+
+    Parameters
+    ----------
+        filename: str or None
+            the index file (JSON); None keeps the index in memory only
+
+    Attributes
+    ----------
+        entries: dict
+            {absolute path: scan_file() entry, plus its 'stamp'}
+    """
+    def __init__(self, filename=INDEX_FILE):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        if filename is None:
+            return
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.entries = data['files']
+
+    def save(self):
+        """ write the index if anything was scanned since it was read """
+        if not self.changed or self.filename is None:
+            return
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'files': self.entries}, f)
+        os.replace(tmp, self.filename)
+        self.changed = False
+
+    def entry(self, path):
+        """
+        The entry of an h5 file, scanned now if it is new or has changed
+
+        Raises
+        ------
+            OSError, KeyError
+                if path is not an Opal h5 file
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        held = self.entries.get(path)
+        if held is None or held['stamp'] != stamp:
+            held = dict(scan_file(path), stamp=stamp)
+            self.entries[path] = held
+            self.changed = True
+        return held
+
+    def scan(self, directory, recursive=True):
+        """
+        Index every h5 file under directory
+
+        Entries of files that are gone from directory are dropped.
+
+        Returns
+        -------
+            failed: dict
+                {path: error message} of the files that could not be read
+        """
+        directory = os.path.abspath(directory)
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            paths += [os.path.join(root, x) for x in sorted(files)
+                      if x.lower().endswith(EXTENSIONS)]
+            if not recursive:
+                break
+        failed = {}
+        for path in paths:
+            try:
+                self.entry(path)
+            except (OSError, KeyError) as err:
+                failed[path] = f"{type(err).__name__}: {err}"
+        found = set(paths)
+        for path in list(self.entries):
+            inside = os.path.dirname(path) == directory if not recursive \
+                else path.startswith(directory + os.sep)
+            if inside and path not in found:
+                del self.entries[path]
+                self.changed = True
+        return failed
+
+    def table(self, paths=None):
+        """ one row per sensor: file, then SENSOR_FIELDS """
+        paths = self.entries if paths is None else \
+            [os.path.abspath(x) for x in paths]
+        rows = [dict(file=path, **sensor)
+                for path in paths if path in self.entries
+                for sensor in self.entries[path]['sensors']]
+        return pd.DataFrame(rows, columns=['file'] + SENSOR_FIELDS)
+
+    def sides(self, label_r=None, paths=None):
+        """
+        (left, right) sensor ids of every indexed file at once
+
+        The right sensor is the one label that contains label_r (or one
+        of recording.RIGHT_WORDS), ignoring case, out of two sensors.
+
+        Returns
+        -------
+            {path: (left, right) or None}
+        """
+        table = self.table(paths)
+        words = recording.RIGHT_WORDS if label_r is None else [label_r]
+        words = [x.strip().lower() for x in words if x.strip()]
+        labels = table['label'].astype(str).str.lower()
+        is_right = np.zeros(len(table), bool)
+        for word in words:
+            is_right |= labels.str.contains(word, regex=False).to_numpy()
+        by_file = pd.DataFrame({'file': table['file'], 'right': is_right})\
+            .groupby('file', sort=False)['right']
+        resolved = (by_file.sum() == 1) & (by_file.size() == 2)
+        ok = table['file'].map(resolved).to_numpy(bool)
+        right = table[ok & is_right].set_index('file')['sensor']
+        left = table[ok & ~is_right].set_index('file')['sensor']
+        return {path: (left[path], right[path]) if resolved[path] else None
+                for path in resolved.index}
+
+
+# Loaded once per process, see default_index
+INDEX = None
+
+
+def default_index():
+    """ the H5Index at INDEX_FILE, read on first use """
+    global INDEX
+    if INDEX is None:
+        INDEX = H5Index()
+    return INDEX
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Index the sensors of the h5 files in a directory")
+    parser.add_argument('directory')
+    parser.add_argument('--label-r', default=None,
+                        help="label used for the right side identification "
+                             f"(default: any of {recording.RIGHT_WORDS})")
+    parser.add_argument('--index', default=INDEX_FILE)
+    args = parser.parse_args(argv)
+    index = H5Index(args.index)
+    failed = index.scan(args.directory)
+    index.save()
+    folder = os.path.abspath(args.directory) + os.sep
+    paths = [x for x in index.entries if x.startswith(folder)]
+    for path, pair in index.sides(args.label_r, paths).items():
+        side = f"L={pair[0]} R={pair[1]}" if pair else "sides unresolved"
+        print(f"{os.path.relpath(path, args.directory)}: "
+              f"{describe(index.entries[path])}; {side}")
+    for path, msg in failed.items():
+        print(f"{os.path.relpath(path, args.directory)}: {msg}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+""" Per-stage timing and memory records of the preprocessing
+
+A Recorder hands out stages, used as context managers around each step
+of the pipeline (see pipeline.run_job):
+
+    with recorder.stage('get_mov', side='L') as stage:
+        movs = subject.get_mov()
+        stage.arrays(movs=movs)
+
+Each stage records its wall time, the CPU time of its thread, the peak
+RSS of the process when it ended and how much the stage raised it, and
+the shape and size of the arrays it produced. A disabled Recorder
+(OFF) returns one shared no-op stage, so that instrumented code costs
+a method call per stage when nobody is looking.
+"""
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """ the process's peak resident set size so far, in MB (None if unknown) """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+class Stage:
+    """ one timed step; see Recorder.stage """
+    def __init__(self, recorder, name, info):
+        self.recorder = recorder
+        self.record = dict(stage=name, **info)
+
+    def note(self, **info):
+        """ add info to the record, ex. whether a lookup hit """
+        self.record.update(info)
+
+    def arrays(self, **named):
+        """ note the shape and size (MB) of arrays made by the stage """
+        for name, arr in named.items():
+            if hasattr(arr, 'nbytes'):
+                self.record.setdefault('arrays', {})[name] = {
+                        'shape': list(getattr(arr, 'shape', ())),
+                        'mb': arr.nbytes / 1024**2}
+
+    def __enter__(self):
+        self.peak = peak_rss_mb()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        peak = peak_rss_mb()
+        self.record.update(
+                wall_s=time.perf_counter() - self.wall,
+                cpu_s=time.thread_time() - self.cpu,
+                peak_rss_mb=peak,
+                rss_growth_mb=None if peak is None else peak - self.peak,
+                thread=threading.current_thread().name)
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        self.recorder.add(self.record)
+        return False
+
+
+class NullStage:
+    """ the stage of a disabled Recorder: records nothing """
+    def note(self, **info):
+        pass
+
+    def arrays(self, **named):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Recorder:
+    """ Collects the records of the stages run with it
+
+    Parameters
+    ----------
+        enabled: bool
+            False makes every stage a no-op
+
+    Attributes
+    ----------
+        records: list of dict
+            stage (and side, ...), wall_s, cpu_s, peak_rss_mb,
+            rss_growth_mb, thread, and arrays / error when present;
+            in the order the stages ended
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        # Both sides' stages may end at once (see pipeline.intermediates)
+        self.lock = threading.Lock()
+
+    def stage(self, name, **info):
+        """ a context manager timing the step name (info is recorded too) """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, info)
+
+    def timed(self, name, func, **info):
+        """ func, run as the stage name when called """
+        if not self.enabled:
+            return func
+
+        def run(*args, **kwargs):
+            with self.stage(name, **info) as stage:
+                result = func(*args, **kwargs)
+                stage.arrays(result=result)
+            return result
+        return run
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+
+def write_jsonl(f, records, **common):
+    """ one JSON line per record, with the common fields first """
+    for record in records:
+        f.write(json.dumps(dict(common, **record), default=str) + '\n')
+
+
+# The default of the instrumented functions
+OFF = Recorder(enabled=False)
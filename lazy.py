@@ -0,0 +1,58 @@
+""" Deferred imports of heavy modules
+
+The GUIs (app.py, testzero.py) only need PyQt6 to show their first
+window. Modules such as pandas, h5py or cv2 are bound to a LazyModule
+instead, imported on first attribute access, and warm_up imports them
+on a background thread once the window is up, so that they are usually
+ready by the time they are used.
+"""
+import importlib
+import threading
+
+
+class LazyModule:
+    """ stands for the module name until an attribute is needed
+
+    Parameters
+    ----------
+        name: str
+            absolute module name, ex. 'numpy'
+    """
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def load(self):
+        """ the module itself, imported now if needed """
+        if self.module is None:
+            # The import lock makes this safe against warm_up
+            self.__dict__['module'] = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.module is not None else 'not loaded'
+        return f"<LazyModule {self.name!r} ({state})>"
+
+
+def warm_up(*modules):
+    """
+    Import LazyModules on a daemon thread
+
+    Returns
+    -------
+        thread: threading.Thread
+            already started
+    """
+    def run():
+        for module in modules:
+            try:
+                module.load()
+            except ImportError as err:
+                # Reported again when the module is actually used
+                print(f"Could not import {module.name}: {err}")
+    thread = threading.Thread(target=run, name='warm_up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,487 @@
+""" The preprocessing sequence behind ProcessingWindow.run_preprocess
+
+Kept free of PyQt6 so that it can run headless (see batch.py).
+A subject is an apdm.OpalV2 or an axivity.Ax6 object; a job (OpalJob,
+Ax6Job) holds what is needed to load one, and run_job preprocesses it
+through the on-disk cache of intermediates (see cache.py). Subjects do
+not go through recording.SensorRecording: the viewer and the
+preprocessing each read a recording on their own.
+
+Within a session, a StageMemo keeps the result of every stage along
+with the inputs it declared, so that changing one setting only reruns
+the stages downstream of it.
+"""
+import contextlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import apdm
+import axivity
+import cache
+import h5index
+import instrument
+import recording
+from redcap import NAT_US, RedcapIndex
+
+# Output variables, in the order they are reported
+OUTPUTS = ['record_hours', 'awake_hours', 'sleep_hours',
+           'movrate_l', 'movrate_r', 'avgacc_l', 'avgacc_r',
+           'peakacc_l', 'peakacc_r']
+# Sides of a subject, in the order of subject.info.recordlen
+SIDES = ['L', 'R']
+# Steps of each side's chain (see side_chain)
+CHAIN = ['get_mov', 'cycle_filt', 'acc_per_mov', 'time_asleep']
+# Stages reported to the progress callback, loading included; the two
+# sides' stages interleave when they run in parallel
+STAGES = ['load'] + [f'{x} ({side})' for side in SIDES for x in CHAIN]
+# Part of every cache key; bump it when the intermediates change
+PIPELINE_VERSION = 1
+# Intermediates stored as arrays; the rest go to the entry's meta.json
+ARRAYS = ['lmovs', 'rmovs', 'lmovs_del', 'rmovs_del', 'laccpmov', 'raccpmov']
+
+
+class Cancelled(Exception):
+    """ raised by a progress callback to stop the run between stages """
+
+
+def load_opal(redcap, h5_filename, timezone, label_r):
+    """
+    Load an APDM Opal V2 recording, trimmed to its don/doff times
+
+    Parameters
+    ----------
+        redcap: RedcapIndex or pd.DataFrame
+            formatted REDCap export (id, filename, don_t, doff_t)
+
+        h5_filename: str
+            full path to the h5 file
+
+        timezone: str
+            timezone of the study site, ex. 'America/Los_Angeles'
+
+        label_r: str
+            label used for the right side identification
+
+    Returns
+    -------
+        apdm.OpalV2
+    """
+    in_en_dt = apdm.make_start_end_datetime(
+            study_rows(as_index(redcap), h5_filename), h5_filename, timezone)
+    return apdm.OpalV2(h5_filename, in_en_dt, label_r)
+
+
+def load_ax6(cwa_l_filename, cwa_r_filename):
+    """ Load a pair of Axivity Ax6 recordings (left, right)
+
+    axivity.Ax6 takes file names and decodes both files itself on every
+    load; the decoded copies of cwa.read are not used here (only the
+    viewer reads them, through recording.Ax6Recording).
+    """
+    return axivity.Ax6(cwa_l_filename, cwa_r_filename)
+
+
+class StageMemo:
+    """ The last result of each stage, kept with the inputs it was computed from
+
+    A stage is rerun only when one of its declared inputs differs from
+    last time. Each slot holds one result, so memory stays bounded by a
+    single subject.
+    """
+    def __init__(self):
+        self.slots = {}
+
+    def get(self, slot, inputs, func, *args):
+        """
+        Parameters
+        ----------
+            slot: hashable
+                stage name (and sensor, for per-side stages)
+
+            inputs: list
+                everything the result depends on (compared as JSON,
+                with str for the rest)
+
+            func: callable
+                computes the result from args
+
+        Returns
+        -------
+            func(*args), or the result held for the same inputs
+        """
+        stamp = json.dumps(inputs, sort_keys=True, default=str)
+        held = self.slots.get(slot)
+        if held is not None and held[0] == stamp:
+            return held[1]
+        value = func(*args)
+        self.slots[slot] = (stamp, value)
+        return value
+
+
+def file_stamp(path):
+    """ identifies a file version cheaply: (path, size, mtime) """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def sensor_sides(h5_filename, label_r):
+    """
+    (left, right) sensor ids that label_r picks in an Opal h5 file
+
+    From the metadata index (see h5index.py), with the rule of
+    recording.find_right: the one of two labels that contains label_r,
+    ignoring case. None if the file cannot be indexed or label_r does
+    not pick one sensor.
+    """
+    try:
+        sensors = h5index.default_index().entry(h5_filename)['sensors']
+    except (OSError, KeyError):
+        return None
+    right = recording.find_right([x['label'] for x in sensors], [label_r])
+    if len(sensors) != 2 or right is None:
+        return None
+    return [sensors[1 - right]['sensor'], sensors[right]['sensor']]
+
+
+class OpalJob:
+    """ everything needed to load an APDM Opal V2 subject (see load_opal) """
+    def __init__(self, redcap, h5_filename, timezone, label_r):
+        self.redcap = as_index(redcap)
+        self.h5_filename = h5_filename
+        self.timezone = timezone
+        self.label_r = label_r
+
+    def prepare(self, memo, recorder=instrument.OFF):
+        """
+        Load the subject, through memo
+
+        The don/doff window depends on the REDCap rows and on the times
+        they resolve to (on the timezone only through those, once they
+        all parse), the subject on the file, the window and the sensors
+        label_r picks as left and right (see sensor_sides), so that
+        editing label_r without changing the sides reloads nothing.
+
+        Stages that run, rather than come from memo, are recorded as
+        'don_doff' and 'load' by recorder.
+
+        Returns
+        -------
+            subject, sources: see intermediates
+        """
+        h5 = file_stamp(self.h5_filename)
+        window = memo.get('window', [h5] + self.window_inputs(),
+                          recorder.timed('don_doff',
+                                         apdm.make_start_end_datetime),
+                          study_rows(self.redcap, self.h5_filename),
+                          self.h5_filename, self.timezone)
+        inputs = [h5, window, self.sides()]
+        subject = memo.get('subject', inputs,
+                           recorder.timed('load', apdm.OpalV2),
+                           self.h5_filename, window, self.label_r)
+        return subject, [(side, side, inputs) for side in SIDES]
+
+    def sides(self):
+        """ sensor_sides, or label_r itself when they do not resolve """
+        return sensor_sides(self.h5_filename, self.label_r) or self.label_r
+
+    def window_inputs(self):
+        """ the REDCap rows of the file and their epoch times """
+        if self.redcap is None:
+            return [[], self.timezone]
+        epochs = self.redcap.epoch_us(self.h5_filename, self.timezone)
+        times = {col: us.tolist() for col, us in epochs.items()}
+        inputs = [redcap_rows(self.redcap, self.h5_filename), times]
+        if not times or any(NAT_US in x for x in times.values()):
+            inputs.append(self.timezone)
+        return inputs
+
+    def cache_key(self, root=cache.CACHE_DIR):
+        return cache.make_key(
+                [self.h5_filename], root,
+                redcap_rows=redcap_rows(self.redcap, self.h5_filename),
+                timezone=self.timezone, sides=self.sides(),
+                algorithm=algorithm_params())
+
+
+class Ax6Job:
+    """ everything needed to load an Axivity Ax6 subject (see load_ax6) """
+    def __init__(self, cwa_l_filename, cwa_r_filename):
+        self.cwa_l_filename = cwa_l_filename
+        self.cwa_r_filename = cwa_r_filename
+
+    def prepare(self, memo, recorder=instrument.OFF):
+        """ Load the subject, through memo (see OpalJob.prepare) """
+        inputs = [file_stamp(self.cwa_l_filename),
+                  file_stamp(self.cwa_r_filename)]
+        subject = memo.get('subject', inputs,
+                           recorder.timed('load', load_ax6),
+                           self.cwa_l_filename, self.cwa_r_filename)
+        return subject, [(side, side, inputs) for side in SIDES]
+
+    def cache_key(self, root=cache.CACHE_DIR):
+        return cache.make_key([self.cwa_l_filename, self.cwa_r_filename],
+                              root, algorithm=algorithm_params())
+
+
+def as_index(redcap):
+    """ redcap as a RedcapIndex; a DataFrame is indexed here """
+    if redcap is None or isinstance(redcap, RedcapIndex):
+        return redcap
+    return RedcapIndex(redcap)
+
+
+def study_rows(redcap, h5_filename):
+    """
+    what apdm.make_start_end_datetime is given: the rows of h5_filename,
+    or the whole table if none match (apdm then reports it)
+    """
+    if redcap is None:
+        return None
+    rows = redcap.rows(h5_filename)
+    return rows if len(rows) else redcap.table
+
+
+def redcap_rows(redcap, h5_filename):
+    """ the REDCap rows whose filename matches h5_filename, as dicts """
+    if redcap is None:
+        return []
+    return redcap.records(h5_filename)
+
+
+def algorithm_params():
+    """ versions that the cached intermediates depend on """
+    return {'pipeline': PIPELINE_VERSION,
+            'apdm': getattr(apdm, '__version__', None),
+            'axivity': getattr(axivity, '__version__', None)}
+
+
+def run_job(job, progress=None, parallel=False, store=None, memo=None,
+            recorder=instrument.OFF):
+    """
+    Load and preprocess a subject, reusing cached intermediates
+
+    Parameters
+    ----------
+        job: OpalJob or Ax6Job
+
+        progress: callable or None
+            see preprocess; also called with 'load'
+
+        parallel: bool
+            see preprocess
+
+        store: cache.Cache or None
+            where intermediates are looked up and saved; None disables
+            caching
+
+        memo: StageMemo or None
+            results of earlier runs in this session, reused stage by
+            stage on a cache miss
+
+        recorder: instrument.Recorder
+            records the stages that run (see instrument.py)
+
+    Returns
+    -------
+        outdict: dict
+            see preprocess
+    """
+    if progress is None:
+        progress = lambda stage: None
+    progress('load')
+    key = None
+    if store is not None:
+        with recorder.stage('cache_lookup') as stage:
+            key = job.cache_key(store.root)
+            hit = store.get(key)
+            stage.note(hit=hit is not None)
+        if hit is not None:
+            arrays, meta = hit
+            return summarize(dict(arrays, **meta))
+
+    if memo is None:
+        memo = StageMemo()
+    subject, sources = job.prepare(memo, recorder)
+    inter = intermediates(subject, progress, parallel, sources, memo,
+                          recorder)
+    if store is not None:
+        with recorder.stage('cache_store'):
+            store.put(key, {x: inter[x] for x in ARRAYS},
+                      {x: inter[x] for x in inter if x not in ARRAYS})
+    return summarize(inter)
+
+
+def preprocess(subject, progress=None, parallel=False):
+    """
+    Calculate kinematic variables of a subject
+
+    Parameters
+    ----------
+        subject: apdm.OpalV2 or axivity.Ax6
+
+        progress: callable or None
+            called with each name in STAGES[1:] before that stage runs
+            (by both sides when parallel); it may raise Cancelled
+
+        parallel: bool
+            run the left and right chains (see side_chain) on two threads.
+            Both sides call methods of the one subject object, which is
+            not known to be thread-safe, so those calls (get_mov,
+            acc_per_mov) take turns under a lock; cycle_filt and
+            time_asleep, functions of the side's own arrays, overlap.
+            The outputs are the same as with parallel=False. Off by
+            default: get_mov and acc_per_mov are the bulk of the time,
+            so the two threads mostly wait on each other; turn it on
+            once bench_intermediates (benchmarks/bench_pipeline.py)
+            shows a gain for the apdm / axivity in use.
+
+    Returns
+    -------
+        outdict: dict
+            keys: OUTPUTS
+            values: float; acceleration values are median m/s^2
+    """
+    return summarize(intermediates(subject, progress, parallel))
+
+
+def intermediates(subject, progress=None, parallel=False,
+                  sources=None, memo=None, recorder=instrument.OFF):
+    """
+    The movement matrices and sleep times behind the outputs
+
+    Parameters
+    ----------
+        subject, progress, parallel: see preprocess
+
+        sources: list or None
+            (slot, side, inputs) for the left then the right output:
+            the side of subject to read, and the memo slot and inputs of
+            its chain. Default: the subject's own sides
+
+        memo: StageMemo or None
+            where the chains are looked up; None runs them all
+
+        recorder: instrument.Recorder
+            see side_chain
+
+    Returns
+    -------
+        inter: dict
+            ARRAYS, plus record_len (list), lsleep and rsleep
+    """
+    if progress is None:
+        progress = lambda stage: None
+
+    if sources is None:
+        sources = [(side, side, None) for side in SIDES]
+    # hours (sleep, awake) calculation needs the record lengths
+    lengths = dict(zip(SIDES, subject.info.recordlen.values()))
+    record_len = [lengths[side] for _, side, _ in sources]
+
+    # Serializes the calls into subject (see preprocess)
+    lock = threading.Lock()
+
+    def chain(slot, side, inputs):
+        args = (subject, side, lengths[side], progress, recorder, lock)
+        if memo is None:
+            return side_chain(*args)
+        return memo.get(('chain', slot), inputs, side_chain, *args)
+
+    if parallel:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(chain, *x) for x in sources]
+            left, right = [future.result() for future in futures]
+    else:
+        left, right = [chain(*x) for x in sources]
+
+    inter = {'record_len': record_len}
+    for side, chain in [('l', left), ('r', right)]:
+        for name, value in zip(['movs', 'movs_del', 'accpmov', 'sleep'],
+                               chain):
+            inter[side + name] = value
+    return inter
+
+
+def side_chain(subject, side, record_len, progress, recorder=instrument.OFF,
+               lock=None):
+    """
+    get_mov -> cycle_filt -> acc_per_mov -> time_asleep for one side
+
+    Parameters
+    ----------
+        subject: apdm.OpalV2 or axivity.Ax6
+
+        side: str
+            'L' or 'R'
+
+        record_len: int
+            record length of that side
+
+        progress: callable
+
+        recorder: instrument.Recorder
+            records each step as a stage, with side
+
+        lock: threading.Lock or None
+            held around the calls into subject, when the other side
+            may be running
+
+    Returns
+    -------
+        (movs, movs_del, accpmov, sleep)
+    """
+    # The left side is the default side of the subject's methods
+    args, kwargs = ((), {}) if side == 'L' else (('R',), {'side': 'R'})
+    if lock is None:
+        lock = contextlib.nullcontext()
+    progress(f'get_mov ({side})')
+    with recorder.stage('get_mov', side=side) as stage:
+        with lock:
+            movs = subject.get_mov(*args)
+        stage.arrays(movs=movs)
+    progress(f'cycle_filt ({side})')
+    with recorder.stage('cycle_filt', side=side) as stage:
+        movs_del = apdm.cycle_filt(movs)
+        stage.arrays(movs_del=movs_del)
+    # average acceleration per mov / peak acc per mov
+    progress(f'acc_per_mov ({side})')
+    with recorder.stage('acc_per_mov', side=side) as stage:
+        with lock:
+            accpmov = subject.acc_per_mov(movmat=movs_del, **kwargs)
+        stage.arrays(accpmov=accpmov)
+    progress(f'time_asleep ({side})')
+    with recorder.stage('time_asleep', side=side):
+        sleep = apdm.time_asleep(movs_del, record_len)
+    return movs, movs_del, accpmov, sleep
+
+
+def summarize(inter):
+    """ hour and rate math on the per-side intermediates """
+    record_len, lsleep, rsleep = (inter[x] for x in
+                                  ['record_len', 'lsleep', 'rsleep'])
+    lmovs_del, rmovs_del = inter['lmovs_del'], inter['rmovs_del']
+    laccpmov, raccpmov = inter['laccpmov'], inter['raccpmov']
+    # Rounding up sleep times to nearest 5 minutes
+    lsleep_5m, rsleep_5m = map(
+            lambda x: x/1200 - np.mod(x/1200, 5), [lsleep, rsleep])
+
+    lrec_hr = record_len[0]/72000   # 72000 = 20(Hz)*3600(seconds)
+    rrec_hr = record_len[1]/72000
+
+    lsleep_hr, rsleep_hr = map(
+            lambda x: x/60, [lsleep_5m, rsleep_5m])
+
+    awake_hrs = [lrec_hr - lsleep_hr, rrec_hr - rsleep_hr]
+
+    return {'record_hours': np.mean([lrec_hr, rrec_hr]),
+            'awake_hours': np.mean(awake_hrs),
+            'sleep_hours': np.mean([lsleep_hr, rsleep_hr]),
+            'movrate_l': lmovs_del.shape[0] / awake_hrs[0],
+            'movrate_r': rmovs_del.shape[0] / awake_hrs[1],
+            # median does not have the 'dtype' argument
+            'avgacc_l': np.median(laccpmov[:, 1]),
+            'avgacc_r': np.median(raccpmov[:, 1]),
+            'peakacc_l': np.median(laccpmov[:, 2]),
+            'peakacc_r': np.median(raccpmov[:, 2])}
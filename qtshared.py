@@ -0,0 +1,20 @@
+""" Qt objects shared by the windows of app.py and testzero.py """
+import pytz
+from PyQt6.QtCore import QStringListModel
+
+# Built by timezone_model on first use
+_timezones = None
+
+
+def timezone_model():
+    """
+    pytz.all_timezones as a QStringListModel
+
+    Built once and shared by every timezone QComboBox (see
+    QComboBox.setModel), so that opening a window does not copy the
+    ~600 names again. Call it from the GUI thread.
+    """
+    global _timezones
+    if _timezones is None:
+        _timezones = QStringListModel(list(pytz.all_timezones))
+    return _timezones
@@ -0,0 +1,502 @@
+""" One read-only view of a sensor recording, whatever its format
+
+A SensorRecording gives, per side label ('LEFT', 'RIGHT'), the sample
+times in microseconds since the epoch and the Nx3 accelerations in
+m/s^2, plus the sensor ids and the sample rate. Backends:
+
+    OpalV1Recording     APDM Opal V1 h5 file (MonitorLabelList, CaseIdList)
+    OpalV2Recording     APDM Opal V2 h5 file (Sensors/<id>/Configuration)
+    Ax6Recording        a pair of Axivity Ax6 .cwa files (see cwa.py)
+
+open_recording picks the backend from the file. Datasets stored
+contiguously and uncompressed are memory-mapped straight from the h5
+file (the .cwa samples always are, from their decoded copy), so slices
+are views on the OS page cache rather than copies. Chunked or
+compressed datasets, which is how Opal files are usually written, are
+read window by window through H5Window instead.
+
+The viewer (testzero.py) reads recordings through this module. The
+preprocessing (pipeline.py) still loads them with apdm.OpalV2 and
+axivity.Ax6, so the two share no pages; find_right and sensor_labels
+are shared with h5index.py, which checks batch runs.
+
+h5py is imported on first use, so that importing this module stays
+cheap for the GUIs.
+"""
+import os
+import numpy as np
+import cwa
+
+# Rows read from an h5 dataset at a time (rounded to whole chunks)
+READ_ROWS = 1 << 16
+# HDF5 chunk cache per open file
+H5_CACHE_BYTES = 32 * 1024**2
+# Histogram bins and passes of streaming_median
+MEDIAN_BINS = 4096
+MEDIAN_LEVELS = 2
+# Side labels of a recording, in order
+SIDE_LABELS = ['LEFT', 'RIGHT']
+# Words marking the right sensor in an Opal V2 "Label 0",
+# ex. 'Right Leg' or 'Pie derecho'
+RIGHT_WORDS = ['right', 'derecho']
+# Standard gravity, m/s^2 per g
+GRAVITY = 9.80665
+
+
+class H5Window:
+    """ windowed, read-only access to an h5py dataset
+
+    Only the rows asked for are read from the file, so the dataset is
+    never materialized as a whole. Bulk reads are aligned to the
+    dataset's own chunking.
+
+    Parameters
+    ----------
+        dataset: h5py.Dataset
+            (N,) or (N, k) dataset; the file must stay open
+    """
+    def __init__(self, dataset):
+        self.ds = dataset
+        self.shape = dataset.shape
+        # Rows per HDF5 chunk; contiguous datasets get a nominal one
+        self.chunk = dataset.chunks[0] if dataset.chunks else READ_ROWS
+        # Rows per bulk read: a whole number of chunks
+        self.block = max(self.chunk, READ_ROWS // self.chunk * self.chunk)
+        self._firsts = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        n = len(self)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if step < 0:
+                return self[::][key]
+            out = self.ds[start:max(start, stop)]
+            return out[::step] if step != 1 else out
+        key = int(key)
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError(f"index {key} is out of range for {n} rows")
+        return self.ds[key]
+
+    def iter_chunks(self, start=0, stop=None):
+        """ yield (row offset, rows) over [start, stop), chunk-aligned """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        pos = start
+        while pos < stop:
+            end = min((pos // self.block + 1) * self.block, stop)
+            yield pos, self.ds[pos:end]
+            pos = end
+
+    def searchsorted(self, v, side='left'):
+        """ np.searchsorted for a sorted 1-D dataset, reading one chunk
+
+        Bisects on the first element of each chunk and then searches
+        within the single chunk that holds the answer.
+        """
+        values = np.atleast_1d(v)
+        out = np.array([self._searchsorted_one(x, side) for x in values.flat],
+                       dtype=np.intp).reshape(values.shape)
+        return out if np.ndim(v) else int(out[0])
+
+    def _first(self, k):
+        if k not in self._firsts:
+            self._firsts[k] = self.ds[k * self.chunk]
+        return self._firsts[k]
+
+    def _searchsorted_one(self, x, side):
+        n, c = len(self), self.chunk
+        # First chunk whose first element is beyond x
+        lo, hi = 0, (n + c - 1) // c
+        while lo < hi:
+            mid = (lo + hi) // 2
+            first = self._first(mid)
+            if first < x or (side == 'right' and first == x):
+                lo = mid + 1
+            else:
+                hi = mid
+        k = max(lo - 1, 0)
+        rows = self.ds[k * c:min((k + 1) * c, n)]
+        return k * c + int(np.searchsorted(rows, x, side=side))
+
+
+class ArrayWindow:
+    """ the H5Window interface over an array in memory or memory-mapped
+
+    Slices are views of the array, unless scale is set.
+
+    Parameters
+    ----------
+        array: np.ndarray or np.memmap
+            (N,) or (N, k), read-only
+
+        scale: float or None
+            multiplies what is read, ex. g to m/s^2; searchsorted takes
+            values in the scaled unit
+    """
+    def __init__(self, array, scale=None):
+        self.array = array
+        self.shape = array.shape
+        self.scale = scale
+        self.block = READ_ROWS
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        out = self.array[key]
+        return out if self.scale is None else out * self.scale
+
+    def iter_chunks(self, start=0, stop=None):
+        """ yield (row offset, rows) over [start, stop), READ_ROWS at a time """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        for pos in range(start, stop, self.block):
+            yield pos, self[pos:min(pos + self.block, stop)]
+
+    def searchsorted(self, v, side='left'):
+        """ np.searchsorted for a sorted 1-D array """
+        values = np.asarray(v) if self.scale is None \
+            else np.asarray(v) / self.scale
+        out = np.searchsorted(self.array, values, side=side)
+        return out if np.ndim(v) else int(out)
+
+
+def dataset_view(dataset):
+    """
+    read-only access to an h5py dataset, without copying it if possible
+
+    Returns
+    -------
+        ArrayWindow over an np.memmap of the file when the dataset is
+        stored contiguously, uncompressed and in the file itself;
+        otherwise an H5Window
+    """
+    f = dataset.file
+    offset = dataset.id.get_offset()
+    if (dataset.chunks is None and offset is not None and dataset.size and
+            not getattr(dataset, 'external', None) and
+            dataset.dtype.kind in 'iuf' and f.driver in ('sec2', 'stdio')):
+        return ArrayWindow(np.memmap(f.filename, dataset.dtype, 'r',
+                                     offset, dataset.shape))
+    return H5Window(dataset)
+
+
+def decode_label(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def sensor_labels(f):
+    """
+    [(sensor id, label)] of an open Opal h5 file, V1 or V2
+
+    Only attributes are read: 'Label 0' of every sensor in V2, the
+    MonitorLabelList / CaseIdList pair in V1.
+    """
+    if 'Sensors' in f:
+        return [(sid, decode_label(f['Sensors'][sid]['Configuration']
+                                   .attrs.get('Label 0', b'')))
+                for sid in f['Sensors'].keys()]
+    return [(decode_label(sid), decode_label(label))
+            for sid, label in zip(f.attrs['CaseIdList'],
+                                  f.attrs['MonitorLabelList'])]
+
+
+def find_right(labels, words=RIGHT_WORDS):
+    """
+    position of the one label naming the right side
+
+    Parameters
+    ----------
+        labels: list of str
+            sensor labels, ex. ['Left Leg', 'Right Leg']
+
+        words: list of str
+            any of which marks the right side, ignoring case
+
+    Returns
+    -------
+        int, or None if no label or more than one matches
+    """
+    words = [x.strip().lower() for x in words if x.strip()]
+    right = [i for i, x in enumerate(labels)
+             if any(w in x.lower() for w in words)]
+    return right[0] if len(right) == 1 else None
+
+
+class SensorRecording:
+    """ Sample times and accelerations of the sensors of one subject
+
+    Attributes
+    ----------
+        path: str
+            the file (the left file of a pair)
+
+        labels: list of str
+            side labels, SIDE_LABELS for Opal V2 and Ax6
+
+        sensors: dict
+            {label: sensor id}
+
+        times: dict
+            {label: (N,) sample times, microseconds since the epoch}
+            (H5Window or ArrayWindow)
+
+        acc: dict
+            {label: Nx3 accelerations, m/s^2}
+
+        local_time: bool
+            True when times are the device's clock without a timezone
+            (Ax6), to be compared with times localized to UTC
+    """
+    local_time = False
+
+    def __init__(self, path):
+        self.path = path
+        self.labels = list(SIDE_LABELS)
+        self.sensors = {}
+        self.times = {}
+        self.acc = {}
+
+    @property
+    def sample_rate(self):
+        """ samples per second, from the first and last time points """
+        ts = self.times[self.labels[0]]
+        return (len(ts) - 1) * 1e6 / max(ts[-1] - ts[0], 1)
+
+    def close(self):
+        """ release the file(s); the windows are unusable afterwards """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class OpalRecording(SensorRecording):
+    """ an open Opal h5 file, read lazily (see dataset_view) """
+    def __init__(self, path):
+        super().__init__(path)
+        import h5py
+        self.file = h5py.File(path, 'r', rdcc_nbytes=H5_CACHE_BYTES)
+
+    def add_sensor(self, label, sid, group, acc_name):
+        self.sensors[label] = sid
+        self.times[label] = dataset_view(group['Time'])
+        self.acc[label] = dataset_view(group[acc_name])
+
+    def close(self):
+        self.file.close()
+
+
+class OpalV1Recording(OpalRecording):
+    """ APDM Opal V1: one group per case id, labelled by MonitorLabelList """
+    def __init__(self, path):
+        super().__init__(path)
+        pairs = sensor_labels(self.file)
+        self.labels = [label for _, label in pairs]
+        for sid, label in pairs:
+            self.add_sensor(label, sid, self.file[sid],
+                            'Calibrated/Accelerometers')
+
+
+class OpalV2Recording(OpalRecording):
+    """ APDM Opal V2: Sensors/<id>, the right one named by its 'Label 0'
+
+    Parameters
+    ----------
+        right_words: list of str
+            see find_right; when the labels do not single out one
+            sensor, the second is right if its label matches, as the
+            viewer always did
+    """
+    def __init__(self, path, right_words=RIGHT_WORDS):
+        super().__init__(path)
+        pairs = sensor_labels(self.file)
+        ridx = find_right([label for _, label in pairs], right_words)
+        if ridx is None:
+            ridx = int(find_right([pairs[1][1]], right_words) == 0)
+        sids = [sid for sid, _ in pairs]
+        for label, sid in zip(self.labels, [sids[1 - ridx], sids[ridx]]):
+            self.add_sensor(label, sid, self.file['Sensors'][sid],
+                            'Accelerometer')
+
+
+class Ax6Recording(SensorRecording):
+    """ a pair of Axivity Ax6 .cwa files, decoded once by cwa.read """
+    local_time = True
+
+    def __init__(self, cwa_l_filename, cwa_r_filename):
+        super().__init__(cwa_l_filename)
+        for label, path in zip(self.labels,
+                               [cwa_l_filename, cwa_r_filename]):
+            samples, _ = cwa.read(path)
+            self.sensors[label] = os.path.basename(path)
+            self.times[label] = ArrayWindow(samples['time'], scale=1e6)
+            self.acc[label] = ArrayWindow(samples['acc'], scale=GRAVITY)
+
+
+def open_recording(path, right_path=None, right_words=RIGHT_WORDS):
+    """
+    The SensorRecording of a file
+
+    Parameters
+    ----------
+        path: str
+            Opal h5 file, or the left .cwa file
+
+        right_path: str or None
+            the right .cwa file, with a .cwa path
+
+        right_words: list of str
+            see OpalV2Recording
+
+    Returns
+    -------
+        OpalV1Recording, OpalV2Recording or Ax6Recording
+    """
+    if os.path.splitext(path)[1].lower() == '.cwa':
+        if right_path is None:
+            raise ValueError("An Ax6 recording needs a left and a right file")
+        return Ax6Recording(path, right_path)
+    import h5py
+    with h5py.File(path, 'r') as f:
+        is_v2 = 'Sensors' in f
+    if is_v2:
+        return OpalV2Recording(path, right_words)
+    return OpalV1Recording(path)
+
+
+def streaming_median(chunks, bins=MEDIAN_BINS, levels=MEDIAN_LEVELS):
+    """ estimate the median of a series too long to hold in memory
+
+    The series is read 1 + levels times: once for its size and range,
+    then once per level of a nested histogram that narrows down the bin
+    holding the middle value. Only one chunk and a `bins`-long count
+    array are resident at any time.
+
+    Error bound: the estimate is within (max - min) / (2 * bins**levels)
+    of x[(n-1)//2] of the sorted series - the median for odd n, the lower
+    of the two middle values for even n. With the defaults and an
+    accelerometer range of 0-160 m/s^2 that is below 5e-6 m/s^2.
+
+    Parameters
+    ----------
+        chunks: callable
+            returns a fresh iterable of 1-D arrays on every call
+
+        bins: int
+            number of histogram bins per level
+
+        levels: int
+            number of histogram passes
+
+    Returns
+    -------
+        estimate: float
+            nan for an empty series
+    """
+    n, lo, hi = 0, np.inf, -np.inf
+    for c in chunks():
+        if c.size:
+            n += c.size
+            lo, hi = min(lo, c.min()), max(hi, c.max())
+    if n == 0:
+        return np.nan
+    if lo == hi:
+        return float(lo)
+
+    k = (n - 1) // 2     # rank of the value being located
+    below = 0            # number of values left of the selected bin
+    prefix = 0           # selected bin at the previous level
+    scale = 1
+    for _ in range(levels):
+        scale *= bins
+        counts = np.zeros(bins, dtype=np.int64)
+        for c in chunks():
+            idx = np.minimum(((c - lo) * (scale / (hi - lo))).astype(np.int64),
+                             scale - 1)
+            sel = idx[idx // bins == prefix] - prefix * bins
+            counts += np.bincount(sel, minlength=bins)
+        cum = np.cumsum(counts)
+        b = min(int(np.searchsorted(cum, k - below, side='right')), bins - 1)
+        below += int(cum[b - 1]) if b else 0
+        prefix = prefix * bins + b
+    return float(lo + (prefix + 0.5) * (hi - lo) / scale)
+
+
+class MagnitudeSeries:
+    """ detrended accelerometer magnitude, computed per chunk on demand
+
+    Parameters
+    ----------
+        acc: H5Window or ArrayWindow
+            Nx3 accelerometer readings
+
+        row_idx: int
+            index of the data point to start trimming data
+
+        det_opt: str
+            'median' or 'customfunc' (see testzero.OpalCapture.get_mag)
+
+        stream: bool
+            estimate the median with streaming_median instead of
+            holding the whole magnitude vector for an exact one
+    """
+    def __init__(self, acc, row_idx=0, det_opt='median', stream=False):
+        self.acc = acc
+        self.row_idx = row_idx
+        self.det_opt = det_opt
+        self.stream = stream
+        self._offset = None
+
+    def __len__(self):
+        return max(len(self.acc) - self.row_idx, 0)
+
+    @property
+    def offset(self):
+        """ the value subtracted from the magnitude, computed once """
+        if self._offset is None:
+            if self.det_opt == 'median' and self.stream:
+                self._offset = streaming_median(
+                        lambda: (mag for _, mag in self.iter_raw()))
+            elif self.det_opt == 'median':
+                mags = np.empty(len(self))
+                for pos, mag in self.iter_raw():
+                    mags[pos:pos + len(mag)] = mag
+                self._offset = np.median(mags, overwrite_input=True)
+            else:
+                self._offset = GRAVITY
+        return self._offset
+
+    def iter_raw(self, start=0, stop=None):
+        """ yield (offset, magnitude) per chunk, without detrending """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        for pos, rows in self.acc.iter_chunks(self.row_idx + start,
+                                              self.row_idx + stop):
+            yield pos - self.row_idx, np.linalg.norm(rows, axis=1)
+
+    def iter_chunks(self, start=0, stop=None):
+        """ yield (offset, detrended magnitude) per chunk
+
+        Memory stays at one chunk however long the recording is
+        (with stream=True, the median pass is chunked as well).
+        """
+        for pos, mag in self.iter_raw(start, stop):
+            yield pos, mag - self.offset
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[:][key]
+            rows = self.acc[self.row_idx + start:self.row_idx + max(start, stop)]
+            return np.linalg.norm(rows, axis=1) - self.offset
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        return np.linalg.norm(self.acc[self.row_idx + key]) - self.offset
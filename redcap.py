@@ -0,0 +1,376 @@
+""" Formatted REDCap exports, indexed by recording file
+
+The formatted export (see app.ConvertWindow) has one row per recording:
+id, filename, don_t and doff_t. RedcapIndex parses every don/doff time
+once, localizes them per timezone in one vectorized pass, and finds
+the rows of a recording through a dict instead of scanning the table.
+"""
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+# Columns of a formatted export, in order
+COLUMNS = ['id', 'filename', 'don_t', 'doff_t']
+# Left / right files of an Ax6 export, in place of filename
+AX6_FILE_COLUMNS = ['filename_l', 'filename_r']
+# Columns holding text that may look like numbers
+TEXT_COLUMNS = ['id', 'filename'] + AX6_FILE_COLUMNS
+# Columns holding the don / doff times
+TIME_COLUMNS = ['don_t', 'doff_t']
+# Text of the don/doff times in a REDCap export, written back in
+# RedcapIndex.table for Parquet / Feather datetimes (seconds only when
+# a column has them)
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+TIME_FORMAT_SECONDS = '%Y-%m-%d %H:%M:%S'
+# Times a column's format is guessed from
+GUESS_ROWS = 100
+# Rows of a raw export read at a time
+CHUNK_ROWS = 50000
+# Formats of formatted exports, by file extension
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.feather': 'feather'}
+# Epoch microseconds of a time that could not be parsed or localized
+NAT_US = np.iinfo(np.int64).min
+
+
+def export_columns(filename):
+    """ column names of a raw REDCap export, reading only its header """
+    return pd.read_csv(filename, nrows=0).columns.tolist()
+
+
+def read_export(filename, cois, chunksize=CHUNK_ROWS):
+    """
+    The formatted table from a raw REDCap export
+
+    Only the columns of interest are read, all as text, so the time and
+    memory taken do not grow with the other instruments of the export.
+
+    Parameters
+    ----------
+        filename: str
+            raw REDCap export (csv)
+
+        cois: list of str
+            export columns holding COLUMNS, in that order
+
+        chunksize: int or None
+            rows read at a time
+
+    Returns
+    -------
+        pd.DataFrame
+            with COLUMNS
+    """
+    return pd.concat(iter_export(filename, cois, chunksize),
+                     ignore_index=True)
+
+
+def iter_export(filename, cois, chunksize=CHUNK_ROWS):
+    """ read_export, one chunk of rows at a time """
+    usecols = list(dict.fromkeys(cois))
+    dtype = dict.fromkeys(usecols, str)
+    if chunksize is None:
+        chunks = [pd.read_csv(filename, usecols=usecols, dtype=dtype)]
+    else:
+        chunks = pd.read_csv(filename, usecols=usecols, dtype=dtype,
+                             chunksize=chunksize)
+    for raw in chunks:
+        # The same export column may be picked for two items
+        yield pd.DataFrame({new: raw[old] for new, old in zip(COLUMNS, cois)})
+
+
+def drop_incomplete(table):
+    """ rows with both a filename and a don time """
+    keep = np.ones(len(table), bool)
+    for col in ['filename', 'don_t']:
+        keep &= table[col].fillna('').str.strip().ne('').to_numpy()
+    return table[keep]
+
+
+def output_format(outname):
+    """ 'csv', 'parquet' or 'feather', from the extension of outname """
+    ext = os.path.splitext(outname)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown output format {ext!r}, "
+                         f"use one of {', '.join(FORMATS)}")
+    return FORMATS[ext]
+
+
+def convert_export(filename, cois, outname, chunksize=CHUNK_ROWS):
+    """
+    Write the formatted table of a raw REDCap export, streaming
+
+    Rows without a filename or a don time are dropped. CSV keeps the
+    times as they were entered; Parquet and Feather store them as
+    (naive, local) datetimes, NaT where they do not parse, so that the
+    table loads without parsing text. If the conversion fails, outname
+    is left as it was.
+
+    Parameters
+    ----------
+        filename, cois, chunksize: see read_export
+
+        outname: str
+            .csv, .parquet or .feather file
+
+    Returns
+    -------
+        (kept, dropped): (int, int)
+            number of rows written and left out
+    """
+    fmt = output_format(outname)
+    kept = dropped = 0
+    writer = None
+    # {column: time format}, guessed once for all the chunks
+    formats = {}
+    # Written next to outname and moved over it once complete, so a
+    # failed conversion leaves no partial table behind
+    tmp = outname + '.tmp'
+    try:
+        try:
+            for chunk in iter_export(filename, cois, chunksize):
+                table = drop_incomplete(chunk)
+                kept += len(table)
+                dropped += len(chunk) - len(table)
+                if fmt == 'csv':
+                    # The first chunk creates the file, the others append
+                    table.to_csv(tmp, index=False, header=writer is None,
+                                 mode='w' if writer is None else 'a')
+                    writer = tmp
+                else:
+                    writer = write_arrow(writer,
+                                         with_datetimes(table, formats),
+                                         tmp, fmt)
+        finally:
+            if writer is not None and fmt != 'csv':
+                writer.close()
+        if writer is None:
+            # No rows at all: still leave a table with the right columns
+            write_empty(tmp, fmt)
+        os.replace(tmp, outname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return kept, dropped
+
+
+def with_datetimes(table, formats=None):
+    """
+    table with its time columns parsed as datetimes
+
+    Parameters
+    ----------
+        formats: dict or None
+            {column: format}; a column missing from it gets the format
+            guessed from its values, kept there for the next chunks
+    """
+    formats = {} if formats is None else formats
+    table = table.copy()
+    for col in TIME_COLUMNS:
+        if formats.get(col) is None:
+            formats[col] = time_format(table[col])
+        table[col] = parse_times(table[col], formats[col])\
+            .astype('datetime64[us]')
+    return table
+
+
+def time_format(values):
+    """
+    The one format of a column of time text, or None
+
+    Each of the first GUESS_ROWS times suggests a format, and the one
+    that parses most of them wins, so that 03/04/2020 and 13/04/2020 in
+    the same column are both read day first.
+    """
+    sample = values.dropna().astype(str).str.strip()
+    sample = sample[sample != ''].head(GUESS_ROWS)
+    from pandas.tseries.api import guess_datetime_format
+    with warnings.catch_warnings():
+        # guess_datetime_format warns about day-first guesses
+        warnings.simplefilter('ignore')
+        guesses = {guess_datetime_format(x) for x in sample} - {None}
+    if not guesses:
+        return None
+    return max(sorted(guesses), key=lambda fmt: parse_times(sample, fmt)
+               .notna().sum())
+
+
+def parse_times(values, fmt):
+    """ time text parsed with the one format fmt, NaT where it fails """
+    if fmt is None:
+        return pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    if pd.api.types.is_string_dtype(values):
+        values = values.str.strip()
+    return pd.to_datetime(values, errors='coerce', format=fmt)
+
+
+def column_times(values):
+    """ a don/doff column as datetimes, parsing it if it is text """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return parse_times(values, time_format(values))
+
+
+def arrow_schema():
+    """ the Arrow schema of a formatted export with datetimes """
+    import pyarrow as pa
+    return pa.schema([(x, pa.timestamp('us') if x in TIME_COLUMNS
+                       else pa.string()) for x in COLUMNS])
+
+
+def write_arrow(writer, table, outname, fmt):
+    """
+    append table to a Parquet or Feather (Arrow IPC) file
+
+    Every chunk is written with arrow_schema(), so a chunk whose column
+    is all empty is not inferred as another type.
+    """
+    import pyarrow as pa
+    schema = arrow_schema()
+    batch = pa.Table.from_pandas(table, schema=schema, preserve_index=False)
+    if writer is None:
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(outname, schema)
+        else:
+            writer = pa.ipc.new_file(outname, schema)
+    writer.write_table(batch)
+    return writer
+
+
+def write_empty(outname, fmt):
+    table = with_datetimes(pd.DataFrame({x: pd.Series(dtype=str)
+                                         for x in COLUMNS}))
+    if fmt == 'csv':
+        table.to_csv(outname, index=False)
+    else:
+        write_arrow(None, table, outname, fmt).close()
+
+
+def file_key(name):
+    """ a recording's file name as matched against REDCap: no dir, no ext
+
+    Both / and \\ separate directories, wherever the export was made.
+    """
+    name = str(name).strip().replace('\\', '/')
+    return os.path.splitext(name.rsplit('/', 1)[-1])[0]
+
+
+class RedcapIndex:
+    """ A formatted REDCap export, indexed by file_key(filename)
+
+    A csv export keeps its don/doff text as entered. Parquet and Feather
+    store datetimes, which are written back as text in REDCap's own
+    format (TIME_FORMAT), so that apdm and the batch output get text
+    whatever the format; NaT becomes None.
+
+    Parameters
+    ----------
+        table: pd.DataFrame
+            formatted REDCap export (id, filename, don_t, doff_t); an
+            Ax6 export may name its files in filename_l and filename_r
+            instead, and a row is then found by either
+    """
+    def __init__(self, table):
+        self.table = table = table.copy()
+        columns = (['filename'] if 'filename' in table else
+                   [x for x in AX6_FILE_COLUMNS if x in table])
+        if not columns:
+            raise KeyError("A REDCap table needs a filename column, or "
+                           + " and ".join(AX6_FILE_COLUMNS))
+        # The same file_key as the lookups, so the two cannot disagree
+        keys = pd.concat([table[x].map(file_key) for x in columns],
+                         ignore_index=True)
+        rows = np.tile(np.arange(len(table)), len(columns))
+        self.positions = pd.Series(rows).groupby(keys.to_numpy()).indices
+        if len(columns) > 1:
+            # Positions in keys, back to rows of table
+            self.positions = {key: np.unique(rows[at])
+                              for key, at in self.positions.items()}
+        self.times = {col: column_times(table[col])
+                      for col in TIME_COLUMNS if col in table}
+        for col, times in self.times.items():
+            if pd.api.types.is_datetime64_any_dtype(table[col]):
+                table[col] = times_text(times)
+        # {timezone: {column: epoch microseconds of every row}}
+        self.epochs = {}
+
+    @classmethod
+    def read(cls, filename):
+        """ index a formatted export saved as csv, parquet or feather
+
+        ids and filenames are read as text, so that leading zeros
+        (ex. record 007) are kept.
+        """
+        fmt = output_format(filename)
+        if fmt == 'csv':
+            table = pd.read_csv(filename, dtype=dict.fromkeys(TEXT_COLUMNS,
+                                                               str))
+        elif fmt == 'parquet':
+            table = pd.read_parquet(filename)
+        else:
+            table = pd.read_feather(filename)
+        for col in TEXT_COLUMNS:
+            if col in table:
+                table[col] = table[col].astype(object).where(
+                        table[col].isna(), table[col].astype(str))
+        return cls(table)
+
+    def __len__(self):
+        return len(self.table)
+
+    def rows(self, filename):
+        """ the rows of the recording filename (a DataFrame, maybe empty) """
+        return self.table.iloc[self.positions.get(file_key(filename), [])]
+
+    def records(self, filename):
+        """ rows(filename) as a list of dicts """
+        return self.rows(filename).to_dict('records')
+
+    def epoch_us(self, filename, timezone):
+        """
+        don/doff times of a recording in microseconds since the epoch,
+        the unit of the h5 'Time' datasets
+
+        Parameters
+        ----------
+            filename: str
+                recording file, matched with file_key
+
+            timezone: str
+                timezone of the study site, ex. 'America/Los_Angeles'
+
+        Returns
+        -------
+            {column: np.ndarray of int64}
+                one value per matching row, NAT_US where the time could
+                not be parsed, or does not exist in that timezone
+        """
+        pos = self.positions.get(file_key(filename), [])
+        return {col: us[pos] for col, us in self.localize(timezone).items()}
+
+    def localize(self, timezone):
+        """ {column: epoch microseconds of every row}, computed once """
+        if timezone not in self.epochs:
+            self.epochs[timezone] = {
+                    col: localize_us(times, timezone)
+                    for col, times in self.times.items()}
+        return self.epochs[timezone]
+
+
+def times_text(times):
+    """ datetimes (pd.Series) as REDCap export text, None for NaT """
+    valid = times.dropna()
+    seconds = ((valid.dt.second != 0) | (valid.dt.microsecond != 0)).any()
+    fmt = TIME_FORMAT_SECONDS if seconds else TIME_FORMAT
+    return times.dt.strftime(fmt).astype(object).where(times.notna(), None)
+
+
+def localize_us(times, timezone):
+    """ naive times (pd.Series) read in timezone, as epoch microseconds """
+    if times.dt.tz is None:
+        times = times.dt.tz_localize(timezone, ambiguous='NaT',
+                                     nonexistent='NaT')
+    utc = times.dt.tz_convert('UTC').dt.tz_localize(None)
+    return utc.to_numpy(dtype='datetime64[us]').astype(np.int64)
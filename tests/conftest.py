@@ -0,0 +1,7 @@
+""" Puts the repository (and benchmarks/synthetic.py) on the path """
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
@@ -0,0 +1,55 @@
+""" cache.py: the on-disk store of intermediates and its keys """
+import os
+import time
+import numpy as np
+import cache
+
+
+def test_put_get(tmp_path):
+    store = cache.Cache(str(tmp_path))
+    arrays = {'movs': np.arange(6.).reshape(2, 3), 'empty': np.zeros(0)}
+    store.put('k', arrays, {'record_len': [10, 12]})
+    got, meta = store.get('k')
+    assert set(got) == set(arrays)
+    np.testing.assert_array_equal(got['movs'], arrays['movs'])
+    assert meta == {'record_len': [10, 12]}
+    assert store.get('missing') is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    big = {'a': np.zeros(1000)}
+    # Room for three entries (arrays plus their meta.json)
+    store = cache.Cache(str(tmp_path), max_bytes=int(3.5 * big['a'].nbytes))
+    for key in ['a', 'b', 'c']:
+        store.put(key, big)
+        time.sleep(0.01)
+    # Reading 'a' leaves 'b' as the least recently used
+    assert store.get('a') is not None
+    time.sleep(0.01)
+    store.put('d', big)
+    assert store.get('b') is None
+    for key in ['a', 'c', 'd']:
+        assert store.get(key) is not None
+
+
+def test_key_follows_file_content(tmp_path):
+    data = tmp_path / 'subject.h5'
+    data.write_bytes(b'first')
+    root = str(tmp_path / 'cache')
+    key = cache.make_key([str(data)], root, timezone='UTC')
+    assert cache.make_key([str(data)], root, timezone='UTC') == key
+    assert cache.make_key([str(data)], root, timezone='GMT') != key
+
+    # Same size, new content and mtime: the digest memo must not hold
+    data.write_bytes(b'secnd')
+    os.utime(data, ns=(time.time_ns() + 10**9,) * 2)
+    assert cache.make_key([str(data)], root, timezone='UTC') != key
+
+
+def test_digest_reuses_memo_until_file_changes(tmp_path):
+    data = tmp_path / 'subject.h5'
+    data.write_bytes(b'content')
+    root = str(tmp_path / 'cache')
+    digest = cache.file_digest(str(data), root)
+    assert os.path.exists(os.path.join(root, 'digests.json'))
+    assert cache.file_digest(str(data), root) == digest
@@ -0,0 +1,85 @@
+""" cwa.py: decoding against a sector-by-sector reference """
+import os
+import struct
+from datetime import datetime, timezone
+import numpy as np
+import pytest
+import cwa
+import synthetic
+
+# The fields of a data sector before its 480 data bytes
+FIELDS = struct.Struct('<HHHIIIHHBBBBhH')
+
+
+def reference_decode(path):
+    """
+    Samples of a .cwa file, one sector at a time with struct
+
+    Returns
+    -------
+        acc, gyro: np.ndarray
+            n x 3, in g and deg/s
+
+        anchors: list
+            (sample index, time in s) of every sector's timestamp
+    """
+    acc, gyro, anchors = [], [], []
+    with open(path, 'rb') as f:
+        while True:
+            sector = f.read(512)
+            if len(sector) < 512:
+                break
+            (header, length, _, _, _, ts, light, _, _, _, rate, axes_bps,
+             offset, count) = FIELDS.unpack_from(sector)
+            if header != cwa.DATA_HEADER or length != cwa.DATA_LENGTH:
+                continue
+            axes = axes_bps >> 4
+            raw = struct.unpack_from(f'<{count * axes}h', sector, FIELDS.size)
+            acc_unit = 1 << (8 + (light >> 13 & 0x07))
+            code = light >> 10 & 0x07
+            gyro_unit = (8000 >> code if code else 2000) / 32768
+            when = datetime((ts >> 26 & 0x3f) + 2000, ts >> 22 & 0x0f,
+                            ts >> 17 & 0x1f, ts >> 12 & 0x1f, ts >> 6 & 0x3f,
+                            ts & 0x3f, tzinfo=timezone.utc)
+            anchors.append((len(acc) + offset, when.timestamp()))
+            for i in range(count):
+                sample = raw[i * axes:(i + 1) * axes]
+                gyro.append([x * gyro_unit for x in sample[:3]])
+                acc.append([x / acc_unit for x in sample[3:]])
+    return np.array(acc), np.array(gyro), anchors
+
+
+@pytest.fixture
+def recording(tmp_path):
+    return synthetic.make_cwa(str(tmp_path / 'left.cwa'), hours=0.01)
+
+
+def test_read_matches_reference(recording, tmp_path, monkeypatch):
+    # Several chunks, so the seams between threads are covered
+    monkeypatch.setattr(cwa, 'CHUNK_SECTORS', 7)
+    samples, rate = cwa.read(recording, str(tmp_path / 'cache'))
+    acc, gyro, anchors = reference_decode(recording)
+    assert rate == 100
+    assert len(samples) == len(acc) == 3600
+    np.testing.assert_allclose(samples['acc'], acc, rtol=1e-6)
+    np.testing.assert_allclose(samples['gyro'], gyro, rtol=1e-6)
+    # The last anchor may point just past the last sample
+    index, seconds = np.array([x for x in anchors if x[0] < len(acc)]).T
+    np.testing.assert_allclose(samples['time'][index.astype(int)], seconds)
+    # Samples are evenly spaced from the start of the file
+    expected = synthetic.START_US / 1e6 + np.arange(len(acc)) / rate
+    np.testing.assert_allclose(samples['time'], expected, atol=1e-6)
+
+
+def test_read_reuses_the_decoded_file(recording, tmp_path):
+    folder = str(tmp_path / 'cache')
+    first, _ = cwa.read(recording, folder)
+    out = first.filename
+    stamp = os.stat(out).st_mtime_ns
+    again, _ = cwa.read(recording, folder)
+    assert os.stat(out).st_mtime_ns == stamp
+    np.testing.assert_array_equal(first, again)
+    # A changed .cwa file is decoded again
+    synthetic.make_cwa(recording, hours=0.005)
+    changed, _ = cwa.read(recording, folder)
+    assert len(changed) == 1800
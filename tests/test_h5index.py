@@ -0,0 +1,59 @@
+""" h5index.py: sides of every file at once, the saved index """
+import pytest
+import h5index
+
+
+def entry(*labels):
+    return {'opal': 2, 'stamp': [0, 0], 'sensors': [
+            dict(sensor=f'XI-{i}', label=label, sample_rate=128.0,
+                 first_us=0, last_us=1, samples=2)
+            for i, label in enumerate(labels)]}
+
+
+@pytest.fixture
+def index():
+    index = h5index.H5Index(None)
+    index.entries = {
+            '/d/one.h5': entry('Left Leg', 'Right Leg'),
+            '/d/swapped.h5': entry('RIGHT', 'left'),
+            '/d/none.h5': entry('Left Leg', 'Other Leg'),
+            '/d/both.h5': entry('Right arm', 'Right leg'),
+            '/d/three.h5': entry('Left Leg', 'Right Leg', 'Trunk'),
+            '/d/derecho.h5': entry('izquierdo', 'derecho')}
+    return index
+
+
+def test_sides(index):
+    sides = index.sides()
+    assert sides['/d/one.h5'] == ('XI-0', 'XI-1')
+    assert sides['/d/swapped.h5'] == ('XI-1', 'XI-0')
+    assert sides['/d/derecho.h5'] == ('XI-0', 'XI-1')
+    # No right label, two of them, or three sensors
+    for path in ['/d/none.h5', '/d/both.h5', '/d/three.h5']:
+        assert sides[path] is None
+    # The same rule as recording.find_right
+    for path, held in index.entries.items():
+        right = h5index.right_label(held)
+        if sides[path] is not None:
+            labels = {x['sensor']: x['label'] for x in held['sensors']}
+            assert labels[sides[path][1]] == right
+
+
+def test_sides_label_r(index):
+    sides = index.sides(' arm ', ['/d/both.h5', '/d/one.h5'])
+    assert sides == {'/d/both.h5': ('XI-1', 'XI-0'), '/d/one.h5': None}
+    # Not derecho once label_r is given
+    assert index.sides('right')['/d/derecho.h5'] is None
+    assert index.sides('Other')['/d/none.h5'] == ('XI-0', 'XI-1')
+
+
+def test_scan_and_save(tmp_path):
+    synthetic = pytest.importorskip('synthetic')
+    pytest.importorskip('h5py')
+    path = synthetic.make_opal(str(tmp_path / 'opal.h5'), hours=0.001)
+    index = h5index.H5Index(h5index.index_file(str(tmp_path / 'cache')))
+    assert index.scan(str(tmp_path)) == {}
+    index.save()
+    again = h5index.H5Index(index.filename)
+    assert again.entries == index.entries
+    assert again.sides() == {path: tuple(x[0] for x in synthetic.SENSORS)}
@@ -0,0 +1,48 @@
+""" pipeline: which stages run again, and the sides keying the subject """
+import pytest
+
+pytest.importorskip('apdm')
+import pipeline
+
+
+def test_memo_hits_and_misses():
+    memo = pipeline.StageMemo()
+    calls = []
+
+    def stage(x):
+        calls.append(x)
+        return x * 2
+
+    assert memo.get('a', [1, 'UTC'], stage, 1) == 2
+    assert memo.get('a', [1, 'UTC'], stage, 1) == 2
+    assert calls == [1]
+    # Another input reruns the stage and replaces the held result
+    assert memo.get('a', [1, 'GMT'], stage, 3) == 6
+    assert memo.get('a', [1, 'UTC'], stage, 1) == 2
+    assert calls == [1, 3, 1]
+    # Slots are independent
+    assert memo.get(('chain', 'b'), [1, 'UTC'], stage, 5) == 10
+    assert calls == [1, 3, 1, 5]
+
+
+def test_memo_compares_inputs_as_json():
+    memo = pipeline.StageMemo()
+    calls = []
+    stage = lambda: calls.append(1) or len(calls)
+    memo.get('s', [{'b': 1, 'a': 2}], stage)
+    memo.get('s', [{'a': 2, 'b': 1}], stage)
+    assert calls == [1]
+
+
+def test_sensor_sides(tmp_path):
+    synthetic = pytest.importorskip('synthetic')
+    path = synthetic.make_opal(str(tmp_path / 'opal.h5'), hours=0.001)
+    left, right = [x[0] for x in synthetic.SENSORS]
+    for label_r in ['Right', 'right', ' RIGHT leg', 'ight']:
+        assert pipeline.sensor_sides(path, label_r) == [left, right]
+    assert pipeline.sensor_sides(path, 'left') == [right, left]
+    # Both labels, none, or not an Opal file
+    assert pipeline.sensor_sides(path, 'leg') is None
+    assert pipeline.sensor_sides(path, 'arm') is None
+    assert pipeline.sensor_sides(str(tmp_path / 'missing.h5'), 'right') \
+        is None
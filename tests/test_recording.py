@@ -0,0 +1,43 @@
+""" recording.py: streaming median, H5Window lookups """
+import numpy as np
+import pytest
+import recording
+
+
+def chunked(x, size):
+    return lambda: (x[i:i + size] for i in range(0, len(x), size))
+
+
+@pytest.mark.parametrize('n', [1, 2, 1000, 1001, 65537])
+@pytest.mark.parametrize('bins, levels', [(16, 1), (16, 2), (4096, 2)])
+def test_streaming_median_error_bound(n, bins, levels):
+    rng = np.random.default_rng(n)
+    # Skewed, like accelerometer magnitudes
+    x = rng.gamma(2.0, 2.0, n)
+    estimate = recording.streaming_median(chunked(x, 997), bins, levels)
+    target = np.sort(x)[(n - 1) // 2]
+    bound = (x.max() - x.min()) / (2 * bins**levels)
+    assert abs(estimate - target) <= bound + 1e-12
+
+
+def test_streaming_median_edge_cases():
+    assert np.isnan(recording.streaming_median(chunked(np.zeros(0), 4)))
+    assert recording.streaming_median(chunked(np.full(10, 3.5), 4)) == 3.5
+
+
+@pytest.mark.parametrize('chunks', [(7,), (64,), None])
+def test_h5window_searchsorted(tmp_path, chunks):
+    h5py = pytest.importorskip('h5py')
+    rng = np.random.default_rng(0)
+    # Sorted, with runs of equal values across chunk boundaries
+    data = np.sort(rng.integers(0, 60, 200)).astype(np.uint64)
+    with h5py.File(tmp_path / 'sorted.h5', 'w') as f:
+        window = recording.H5Window(
+                f.create_dataset('Time', data=data, chunks=chunks))
+        queries = np.arange(-1, 62)
+        for side in ['left', 'right']:
+            expected = np.searchsorted(data, queries, side=side)
+            assert window.searchsorted(queries, side).tolist() \
+                == expected.tolist()
+            assert [window.searchsorted(x, side) for x in queries] \
+                == expected.tolist()
@@ -0,0 +1,146 @@
+""" redcap.py: the REDCap index and don/doff times """
+import pandas as pd
+import pytest
+import redcap
+
+TZ = 'America/Los_Angeles'
+
+
+def index(filenames, don=None):
+    n = len(filenames)
+    return redcap.RedcapIndex(pd.DataFrame({
+            'id': [str(i) for i in range(n)],
+            'filename': filenames,
+            'don_t': don or ['2020-01-01 10:00'] * n,
+            'doff_t': ['2020-01-02 09:00'] * n}))
+
+
+def test_rows_by_file_key():
+    rc = index(['20200101-1.h5', 'data/20200101-1.h5', '20200101-2',
+                ' 20200101-3.h5 '])
+    assert rc.rows('/elsewhere/20200101-1.h5')['id'].tolist() == ['0', '1']
+    assert rc.rows('20200101-2.h5')['id'].tolist() == ['2']
+    assert rc.rows('20200101-3')['id'].tolist() == ['3']
+    assert rc.rows('nothing.h5').empty
+
+
+def test_rows_by_file_key_windows_paths_and_dots():
+    rc = index([r'C:\data\20200101-1.h5', 'sub.01.visit.2.h5',
+                r'share\sub.01.visit.3.h5'])
+    assert rc.rows('20200101-1.h5')['id'].tolist() == ['0']
+    assert rc.rows(r'D:\copy\20200101-1')['id'].tolist() == ['0']
+    assert rc.rows('/data/sub.01.visit.2.h5')['id'].tolist() == ['1']
+    assert rc.rows('sub.01.visit.3.h5')['id'].tolist() == ['2']
+    assert rc.rows('sub.01.visit').empty
+    # The index and the lookups share file_key
+    for name in rc.table['filename']:
+        assert redcap.file_key(name) in rc.positions
+
+
+def test_epoch_us_localizes():
+    rc = index(['a.h5', 'b.h5', 'c.h5', 'd.h5'],
+               ['2020-01-01 10:00', '2020-07-01 10:00',
+                # Skipped and repeated hours of the DST changes
+                '2020-03-08 02:30', 'not a time'])
+    us = {name: rc.epoch_us(name, TZ)['don_t'][0]
+          for name in ['a', 'b', 'c', 'd']}
+    assert us['a'] == 1577901600 * 10**6     # 18:00 UTC (PST)
+    assert us['b'] == 1593622800 * 10**6     # 17:00 UTC (PDT)
+    assert us['c'] == redcap.NAT_US
+    assert us['d'] == redcap.NAT_US
+    assert rc.epoch_us('a', 'UTC')['don_t'][0] == 1577872800 * 10**6
+
+
+def test_read_keeps_ids_and_filenames_as_text(tmp_path):
+    path = tmp_path / 'formatted.csv'
+    path.write_text("id,filename,don_t,doff_t\n"
+                    "007,20200101,2020-01-01 10:00,2020-01-02 09:00\n"
+                    "010,0042.h5,2020-01-01 10:00,\n")
+    rc = redcap.RedcapIndex.read(str(path))
+    assert rc.table['id'].tolist() == ['007', '010']
+    assert rc.rows('20200101.h5')['id'].tolist() == ['007']
+    assert rc.rows('/data/0042.h5')['id'].tolist() == ['010']
+
+
+@pytest.fixture
+def raw_export(tmp_path):
+    path = tmp_path / 'export.csv'
+    pd.DataFrame({
+            'record_id': ['007', '008', '009', '010', '011'],
+            'h5_file': ['a.h5', 'b.h5', '', 'd.h5', 'e.h5'],
+            'time_donned': ['2020-01-01 10:00', '2020-01-02 10:00',
+                            '2020-01-03 10:00', 'not a time',
+                            '2020-01-05 10:00'],
+            # Empty for a whole chunk, at chunksize 2
+            'time_doffed': [None, None, None, None, '2020-01-06 09:00'],
+            }).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize('ext', ['.csv', '.parquet', '.feather'])
+def test_convert_export_round_trip(raw_export, tmp_path, ext):
+    if ext != '.csv':
+        pytest.importorskip('pyarrow')
+    cois = ['record_id', 'h5_file', 'time_donned', 'time_doffed']
+    out = str(tmp_path / ('formatted' + ext))
+    assert redcap.convert_export(raw_export, cois, out, chunksize=2) == (4, 1)
+    rc = redcap.RedcapIndex.read(out)
+    assert rc.table['id'].tolist() == ['007', '008', '010', '011']
+    assert rc.rows('e.h5')['id'].tolist() == ['011']
+    us = rc.localize(TZ)
+    assert us['don_t'].tolist() == [1577901600 * 10**6, 1577988000 * 10**6,
+                                    redcap.NAT_US, 1578247200 * 10**6]
+    assert us['doff_t'].tolist() == [redcap.NAT_US] * 3 + [1578330000 * 10**6]
+    # Text as REDCap writes it, whether stored as text or datetimes
+    row, = rc.records('a.h5')
+    assert row['don_t'] == '2020-01-01 10:00'
+    assert pd.isna(row['doff_t'])
+    # csv keeps what was entered; Parquet and Feather have nothing to keep
+    unparsed = rc.table['don_t'].tolist()[2]
+    assert unparsed == 'not a time' if ext == '.csv' else unparsed is None
+
+
+def test_convert_export_leaves_no_partial_file(raw_export, tmp_path):
+    out = tmp_path / 'formatted.csv'
+    out.write_text('kept\n')
+    with pytest.raises(ValueError):
+        redcap.convert_export(raw_export, ['record_id', 'missing',
+                                           'time_donned', 'time_doffed'],
+                              str(out), chunksize=2)
+    assert out.read_text() == 'kept\n'
+    assert sorted(x.name for x in tmp_path.iterdir()) \
+        == ['export.csv', 'formatted.csv']
+
+
+def test_times_text_keeps_seconds_only_when_present():
+    times = pd.Series(pd.to_datetime(['2020-01-01 10:00', None]))
+    assert redcap.times_text(times).tolist() == ['2020-01-01 10:00', None]
+    times = pd.Series(pd.to_datetime(['2020-01-01 10:00:00',
+                                      '2020-01-01 10:00:30']))
+    assert redcap.times_text(times).tolist() == ['2020-01-01 10:00:00',
+                                                 '2020-01-01 10:00:30']
+
+
+def test_one_time_format_per_column():
+    rc = index(['a.h5', 'b.h5', 'c.h5'],
+               ['03/04/2020 10:00', '13/04/2020 10:00', ' 2020-04-03 10:00'])
+    # Day first for both, as 13/04 rules out month first
+    assert rc.times['don_t'].tolist()[:2] == [
+            pd.Timestamp('2020-04-03 10:00'), pd.Timestamp('2020-04-13 10:00')]
+    # Another format in the same column does not parse
+    assert pd.isna(rc.times['don_t'][2])
+    times = redcap.with_datetimes(rc.table)['don_t']
+    assert times.tolist()[:2] == rc.times['don_t'].tolist()[:2]
+
+
+def test_ax6_layout(tmp_path):
+    path = tmp_path / 'formatted.csv'
+    path.write_text("id,filename_l,filename_r,don_t,doff_t\n"
+                    "007,0011.cwa,0012.cwa,2020-01-01 10:00,\n"
+                    "008,0021.cwa,0021.cwa,2020-01-01 10:00,\n")
+    rc = redcap.RedcapIndex.read(str(path))
+    assert rc.table['filename_l'].tolist() == ['0011.cwa', '0021.cwa']
+    assert rc.rows('0011.cwa')['id'].tolist() == ['007']
+    assert rc.rows('0012')['id'].tolist() == ['007']
+    assert rc.rows('0021.cwa')['id'].tolist() == ['008']
+    assert rc.epoch_us('0012', TZ)['don_t'].tolist() == [1577901600 * 10**6]
@@ -0,0 +1,96 @@
+""" testzero.py: OpalCapture's sample lookups, FrameCache, EnvelopePyramid """
+import numpy as np
+import pytest
+import pytz
+
+pytest.importorskip('PyQt6')
+pytest.importorskip('h5py')
+import synthetic
+import testzero
+from recording import open_recording
+
+STEP_US = int(round(1e6 / synthetic.OPAL_RATE))
+# synthetic.START_US in America/Los_Angeles
+START = [2020, 1, 1, 10, 0, 0]
+TZ = pytz.timezone('America/Los_Angeles')
+
+
+@pytest.fixture
+def capture(tmp_path):
+    path = synthetic.make_opal(str(tmp_path / 'opal.h5'), hours=0.01)
+    capture = testzero.OpalCapture(open_recording(path))
+    yield capture
+    capture.close()
+
+
+def test_sample_index(capture):
+    n = len(capture.sensorTs)
+    start, last = synthetic.START_US, synthetic.START_US + (n - 1) * STEP_US
+    times = [start - 1, start, start + STEP_US - 1, start + STEP_US, last,
+             last + 10**6]
+    assert capture.sample_index(times).tolist() == [-1, 0, 0, 1, n - 1, n - 1]
+    assert capture.sample_index(start + 2 * STEP_US) == 2
+
+
+def test_update(capture, capsys):
+    assert capture.update(START, TZ) == 0
+    # The last sample at or before the start
+    assert capture.update(START[:5] + [1], TZ) == 10**6 // STEP_US
+    assert capture.dp_idx == 10**6 // STEP_US
+    # Before the first sample: sample 0, with a message
+    assert capture.update(START[:3] + [9, 59, 0], TZ) == 0
+    assert 'precedes' in capsys.readouterr().out
+    # After the last sample
+    with pytest.raises(ValueError):
+        capture.update(START[:3] + [11, 0, 0], TZ)
+
+
+def test_sample_ranges(capture):
+    n = len(capture.sensorTs)
+    start = synthetic.START_US
+    last = start + (n - 1) * STEP_US
+    starts, ends = capture.sample_ranges(
+            [start - 10**6, start + STEP_US, last + 1, start],
+            [start, start + 3 * STEP_US, last + 10**6, start - 1])
+    assert starts.tolist() == [0, 1, n, 0]
+    assert ends.tolist() == [1, 4, n, 0]
+    data = np.arange(n)
+    assert len(data[starts[2]:ends[2]]) == 0
+
+
+def test_frame_cache_drops_stale_sizes():
+    cache = testzero.FrameCache(capacity=2, size=(4, 3))
+    cache.put(0, np.zeros((3, 4, 3), np.uint8))
+    cache.resize((8, 6))
+    assert 0 not in cache
+    # Prepared before the resize, finished after it
+    cache.put(1, np.zeros((3, 4, 3), np.uint8))
+    assert 1 not in cache
+    cache.put(2, np.zeros((6, 8, 3), np.uint8))
+    assert 2 in cache
+
+
+@pytest.mark.parametrize('base, factor', [(testzero.LOD_BASE,
+                                           testzero.LOD_FACTOR), (3, 2)])
+@pytest.mark.parametrize('start, stop, maxPoints', [
+        (0, 200003, 2000), (12345, 150000, 1000), (999, 1999, 64),
+        (100, 150, 64), (200000, 300000, 64), (500, 400, 64)])
+def test_envelope(base, factor, start, stop, maxPoints):
+    series = np.random.default_rng(1).normal(0, 1, 200003).astype(np.float32)
+    pyramid = testzero.EnvelopePyramid(series, base, factor)
+    x, y, raw = pyramid.envelope(start, stop, maxPoints)
+    start, stop = max(start, 0), min(stop, len(series))
+    if raw:
+        assert stop - start <= maxPoints
+        np.testing.assert_array_equal(y, series[start:stop])
+        return
+    assert len(x) <= maxPoints + 4
+    # (min, max) pairs of whole blocks, covering [start, stop)
+    block = round(x[2] - x[0])
+    assert block in pyramid.blocks
+    first = start // block
+    assert first * block <= start and (first + len(x) // 2) * block >= stop
+    for i in range(len(x) // 2):
+        rows = series[(first + i) * block:(first + i + 1) * block]
+        assert y[2 * i] == rows.min() and y[2 * i + 1] == rows.max()
+    assert pyramid.extent() == (series.min(), series.max())
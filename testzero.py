@@ -2,11 +2,13 @@
 # stackoverflow.com/questions/39303008/load-an-opencv-video-frame-by-frame-using-pyqt
 # stackoverflow.com/questions/46656634/pyqt5-qtimer-count-until-specific-seconds
 import sys
-from datetime import datetime
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 import pytz
-import cv2
 import numpy as np
-import h5py
 import matplotlib
 matplotlib.use('QtAgg')
 from matplotlib.figure import Figure
@@ -16,12 +18,30 @@ from PyQt6.QtWidgets import (QMainWindow, QVBoxLayout, QHBoxLayout, QWidget,
                              QGroupBox, QLineEdit, QComboBox, QStackedLayout,
                              QTabWidget)
 from PyQt6.QtGui import QAction, QPixmap, QImage, QPalette, QColor, QFont
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
 # This needs to be packaged....
 # sys.path.append('/Users/joh/Documents/Personal/incwear/incwear')
 # import apdm
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas,\
         NavigationToolbar2QT as NavigationToolbar
+from lazy import LazyModule, warm_up
+from qtshared import timezone_model
+from recording import READ_ROWS, MagnitudeSeries, open_recording
+
+# Only needed once a video / h5 file is opened; see lazy.py
+cv2 = LazyModule('cv2')
+# Imported by open_recording
+h5py = LazyModule('h5py')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+# Decoded frames kept in memory / frames pre-decoded past the current one
+FRAME_CACHE_SIZE = 64
+READ_AHEAD = 24
+# Below this many pixels the video label has not been laid out yet
+MIN_DISPLAY = 16
+# Samples per block of the finest envelope level / blocks merged per level
+LOD_BASE = 64
+LOD_FACTOR = 4
 
 class Color(QWidget):
     def __init__(self, color):
@@ -33,6 +53,252 @@ class Color(QWidget):
         self.setPalette(palette)
 
 
+class FrameCache:
+    """ bounded LRU cache of display-sized BGR frames keyed by frame number
+
+    Shared between the GUI thread and FrameReader, hence the lock. All
+    frames are of one size; see resize.
+    """
+    def __init__(self, capacity=FRAME_CACHE_SIZE, size=None):
+        self.capacity = capacity
+        # (width, height) of the frames held
+        self.size = size
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, frameNumber):
+        with self._lock:
+            return frameNumber in self._frames
+
+    def get(self, frameNumber):
+        """ the cached frame (now most recently used) or None """
+        with self._lock:
+            frame = self._frames.get(frameNumber)
+            if frame is not None:
+                self._frames.move_to_end(frameNumber)
+            return frame
+
+    def put(self, frameNumber, frame):
+        """ cache frame, unless it is not of self.size: FrameReader may
+        finish a frame prepared before the last resize """
+        with self._lock:
+            if (frame.shape[1], frame.shape[0]) != self.size:
+                return
+            self._frames[frameNumber] = frame
+            self._frames.move_to_end(frameNumber)
+            while len(self._frames) > self.capacity:
+                self._frames.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+    def resize(self, size):
+        """ hold frames of size (width, height) from now on """
+        with self._lock:
+            if size != self.size:
+                self.size = size
+                self._frames.clear()
+
+
+class KeyframeIndex:
+    """ presentation timestamps and keyframe positions of a video
+
+    Built in one pass over the compressed packets (nothing is decoded)
+    and saved next to the video as <video>.idx.npz, keyed by the file's
+    size and mtime so it is reused across sessions.
+
+    Parameters
+    ----------
+        pts: np.ndarray
+            presentation time of each frame in msec, frame 0 at 0
+
+        keyframes: np.ndarray or None
+            sorted frame numbers of the keyframes; None if unknown
+    """
+    def __init__(self, pts, keyframes=None):
+        self.pts = pts
+        self.keyframes = keyframes
+
+    def __len__(self):
+        return len(self.pts)
+
+    @classmethod
+    def load(cls, filename, fps):
+        """ the cached index of filename, (re)built if stale """
+        stat = os.stat(filename)
+        idxname = f"{filename}.idx.npz"
+        try:
+            with np.load(idxname) as cached:
+                if (cached['size'] == stat.st_size
+                        and cached['mtime_ns'] == stat.st_mtime_ns):
+                    keyframes = cached['keyframes']
+                    return cls(cached['pts'],
+                               keyframes if keyframes.size else None)
+        except (OSError, KeyError, ValueError):
+            pass
+        index = cls.build(filename, fps)
+        try:
+            with open(idxname + '.tmp', 'wb') as f:
+                np.savez(f, pts=index.pts,
+                         keyframes=(index.keyframes if index.keyframes
+                                    is not None else np.array([], int)),
+                         size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            os.replace(idxname + '.tmp', idxname)
+        except OSError:
+            print(f"Could not save the frame index next to {filename}")
+        return index
+
+    @classmethod
+    def build(cls, filename, fps):
+        """ read every packet once, without decoding """
+        cap = cv2.VideoCapture(str(filename))
+        # Raw mode: grab() demuxes packets and skips decoding
+        raw = cap.set(cv2.CAP_PROP_FORMAT, -1)
+        pts, key = [], []
+        while cap.grab():
+            pts.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+            key.append(raw and bool(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+        cap.release()
+        pts = np.asarray(pts, dtype=float)
+        key = np.flatnonzero(key)
+        # Packets come in decode order; presentation order sorts by pts
+        order = np.sort(pts)
+        if len(pts) and np.all(np.diff(order) > 0):
+            keyframes = np.searchsorted(order, pts[key])
+            pts = order - order[0]
+        else:
+            # No usable timestamps (e.g. a bare .h264 stream)
+            keyframes = key
+            pts = np.arange(len(pts)) * (1000 / fps)
+        return cls(pts, np.sort(keyframes) if raw and key.size else None)
+
+    def keyframe_before(self, frameNumber):
+        """ the last keyframe at or before frameNumber """
+        if self.keyframes is None:
+            return frameNumber
+        i = np.searchsorted(self.keyframes, frameNumber, side='right')
+        return int(self.keyframes[i - 1]) if i else 0
+
+    def seek(self, cap, pos, frameNumber):
+        """ position cap so that its next read() returns frameNumber
+
+        Parameters
+        ----------
+            cap: cv2.VideoCapture
+
+            pos: int
+                frame the next cap.read() would currently return
+
+            frameNumber: int
+                frame to be read next
+
+        Returns
+        -------
+            frameNumber
+        """
+        start = self.keyframe_before(frameNumber)
+        # Decoding on from the current position is never longer than
+        # decoding on from the keyframe, so only seek when behind it
+        if not start <= pos <= frameNumber:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            pos = start
+        while pos < frameNumber and cap.grab():
+            pos += 1
+        return frameNumber
+
+
+class FrameReader(threading.Thread):
+    """ background thread pre-decoding frames around the current one
+
+    It owns a second cv2.VideoCapture so the GUI's capture is never
+    touched from two threads. Each request replaces the previous one;
+    the window is decoded with a single seek followed by sequential reads.
+
+    Parameters
+    ----------
+        filename: str
+            full path to the video file
+
+        cache: FrameCache
+            where decoded frames are stored
+
+        index: KeyframeIndex
+            where to seek to
+
+        numFrames: int
+            total number of frames
+
+        prepare: callable
+            prepare(frame, size) turns a decoded frame into the array
+            to be cached, of size (width, height)
+
+        window: int
+            number of frames to pre-decode in the stepping direction
+    """
+    def __init__(self, filename, cache, index, numFrames, prepare,
+                 window=READ_AHEAD):
+        super().__init__(daemon=True)
+        self.cap = cv2.VideoCapture(str(filename))
+        self.cache = cache
+        self.index = index
+        self.numFrames = numFrames
+        self.prepare = prepare
+        self.window = window
+        self.pos = 0        # frame the next cap.read() returns
+        self.decodeBuf = None
+        # (frameNumber, direction, size) of the latest request
+        self._request = None
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def request(self, frameNumber, direction, size):
+        """ pre-decode the window after (direction >= 0) or before
+        frameNumber, scaled to size (width, height) """
+        with self._cond:
+            self._request = (frameNumber, direction, size)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._request is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                frameNumber, direction, size = self._request
+                self._request = None
+            if direction >= 0:
+                lo = frameNumber + 1
+                hi = min(frameNumber + self.window, self.numFrames - 1)
+            else:
+                lo, hi = max(frameNumber - self.window, 0), frameNumber - 1
+            missing = [n for n in range(lo, hi + 1) if n not in self.cache]
+            if missing:
+                self._decode(missing[0], missing[-1], size)
+        self.cap.release()
+
+    def _decode(self, first, last, size):
+        self.pos = self.index.seek(self.cap, self.pos, first)
+        for n in range(first, last + 1):
+            # A newer request (or stop) wins over the rest of this window
+            if self._request is not None or self._stopped:
+                break
+            ok, frame = self.cap.read(self.decodeBuf)
+            if not ok:
+                break
+            self.decodeBuf = frame
+            self.pos = n + 1
+            if n not in self.cache:
+                # Dropped by the cache if the label was resized since
+                self.cache.put(n, self.prepare(frame, size))
+
+
 class VideoCapture(QWidget):
     """ use cv2 to 'capture' a video file
 
@@ -51,16 +317,38 @@ class VideoCapture(QWidget):
     -------
         None (video frame visible in the QMainWindow)
     """
+    # Emitted with the frame number every time a frame is shown
+    frameChanged = pyqtSignal(int)
+
     def __init__(self, filename, parent, startframe=0):
         super().__init__()
         self.cap = cv2.VideoCapture(str(filename))
         # Frame per second
         self.fps = self.cap.get(cv2.CAP_PROP_FPS)
-        # Total number of frames
-        self.numFrames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # (width, height) of the decoded frames
+        self.frameSize = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                          int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        # (width, height) frames are scaled to before they are cached
+        self.targetSize = self.frameSize
+        # Keyframes and per-frame timestamps, built once per video
+        self.index = KeyframeIndex.load(filename, self.fps)
+        # Total number of frames (the container's count is an estimate)
+        self.numFrames = (len(self.index) or
+                          int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)))
         # Frame number to be loaded
         self.frameNumber = startframe 
         print(f"Initial Frame: {self.frameNumber}")
+        # Frame the next self.cap.read() returns without a seek
+        self.nextPos = 0
+        # cap.read() decodes into this buffer once it has been allocated
+        self.decodeBuf = None
+        # Seconds each nextFrameSlot took, most recent last
+        self.stepTimes = deque(maxlen=100)
+        # Decoded frames, filled on demand and by the read-ahead thread
+        self.cache = FrameCache(size=self.targetSize)
+        self.reader = FrameReader(filename, self.cache, self.index,
+                                  self.numFrames, self.prepareFrame)
+        self.reader.start()
         # Use QLabel to embed QImage
         self.video_frame = QLabel()
         # Still a blackbox to me, but it works
@@ -90,6 +378,7 @@ class VideoCapture(QWidget):
             None (self.video_frame updated)
         """
         print(f"nextFrameSlot begins at: {self.frameNumber} frame")
+        stepStart = time.perf_counter()
         # If moving certain frames (-1, -5, or -10) will take you to a
         # 'negative' frame, stop at frame = 0.
         if self.frameNumber + count < 0:
@@ -104,21 +393,58 @@ class VideoCapture(QWidget):
             self.frameNumber += count
         print(f"count is {count}. Now you will see frame: {self.frameNumber}")
 
-        # Set to a specific frameNumber
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.frameNumber)
-        _, frame = self.cap.read()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = QImage(frame, frame.shape[1], frame.shape[0],
-                     QImage.Format.Format_RGB888)
+        # Frames are cached at the size of the label showing them
+        targetSize = self.displaySize()
+        if targetSize != self.targetSize:
+            self.targetSize = targetSize
+            self.cache.resize(targetSize)
+
+        frame = self.cache.get(self.frameNumber)
+        if frame is None:
+            # Set to a specific frameNumber through its keyframe,
+            # unless decoding on from the current position is shorter
+            self.index.seek(self.cap, self.nextPos, self.frameNumber)
+            _, self.decodeBuf = self.cap.read(self.decodeBuf)
+            self.nextPos = self.frameNumber + 1
+            frame = self.prepareFrame(self.decodeBuf, self.targetSize)
+            self.cache.put(self.frameNumber, frame)
+        # Keep decoding ahead in the direction the user is stepping
+        self.reader.request(self.frameNumber, count, self.targetSize)
+        # QImage reads the BGR array in place: no color conversion and
+        # no copy until QPixmap uploads it
+        img = QImage(frame.data, frame.shape[1], frame.shape[0],
+                     frame.strides[0], QImage.Format.Format_BGR888)
         pix = QPixmap.fromImage(img)
-        """
-        try:
-            pix = pix.scaled(600, 400, Qt.AspectRatioMode(1))
-        except:
-            print('uh-oh')
-        """
         # updating QLabel with the specific pixel map
         self.video_frame.setPixmap(pix)
+        self.stepTimes.append(time.perf_counter() - stepStart)
+        self.frameChanged.emit(self.frameNumber)
+
+    def displaySize(self):
+        """ (width, height) of the label, capped at the frame size """
+        width, height = self.video_frame.width(), self.video_frame.height()
+        if width < MIN_DISPLAY or height < MIN_DISPLAY:
+            return self.frameSize
+        return (min(width, self.frameSize[0]), min(height, self.frameSize[1]))
+
+    def prepareFrame(self, frame, size):
+        """ scale a decoded frame down to size (width, height)
+
+        Returns a new array, since the decode buffer is reused.
+        Downscaling first means every later step - caching, QImage,
+        QPixmap upload - handles the display size, not the source size.
+        """
+        width, height = size
+        if (frame.shape[1], frame.shape[0]) == (width, height):
+            return frame.copy()
+        return cv2.resize(frame, (width, height),
+                          interpolation=cv2.INTER_AREA)
+
+    def timestamp(self, frameNumber):
+        """ presentation time of frameNumber in msec """
+        if frameNumber < len(self.index):
+            return self.index.pts[frameNumber]
+        return (frameNumber / self.fps) * 1000
 
     def moveByFrames(self, slot, addFrame=1):
         """ Move by designated number of frames, backward or forward
@@ -152,6 +478,9 @@ class VideoCapture(QWidget):
         self.timer.start(int(1000/self.fps)) # Interval does not matter much
 
     def deleteLater(self):
+        self.reader.stop()
+        # At most one frame decode away from finishing
+        self.reader.join(timeout=1)
         self.cap.release()
         super().deleteLater()
 
@@ -186,49 +515,132 @@ class VideoDisplayWidget(QWidget):
         # Use the custom Layout
         self.setLayout(self.customLayout)
 
+class EnvelopePyramid:
+    """ min/max envelopes of a series at several block sizes
+
+    Level l holds the minimum and maximum of every block of
+    base * factor**l samples. Built with one chunked pass over the
+    series, it serves any x range at roughly the resolution of the
+    screen without touching the raw samples.
+
+    Parameters
+    ----------
+        series: MagnitudeSeries or np.ndarray
+
+        base: int
+            samples per block of the finest level
+
+        factor: int
+            blocks of one level merged into a block of the next
+    """
+    def __init__(self, series, base=LOD_BASE, factor=LOD_FACTOR):
+        self.series = series
+        self.n = len(series)
+        self.blocks = []
+        self.mins = []
+        self.maxs = []
+        step = base * (READ_ROWS // base)
+        mins = np.empty(-(-self.n // base), dtype=np.float32)
+        maxs = np.empty_like(mins)
+        for pos in range(0, self.n, step):
+            vals = np.asarray(series[pos:min(pos + step, self.n)])
+            starts = np.arange(0, len(vals), base)
+            mins[pos // base:pos // base + len(starts)] = \
+                    np.minimum.reduceat(vals, starts)
+            maxs[pos // base:pos // base + len(starts)] = \
+                    np.maximum.reduceat(vals, starts)
+        block = base
+        while True:
+            self.blocks.append(block)
+            self.mins.append(mins)
+            self.maxs.append(maxs)
+            if len(mins) <= 1:
+                break
+            pad = -len(mins) % factor
+            mins = np.pad(mins, (0, pad), constant_values=np.inf)\
+                    .reshape(-1, factor).min(axis=1)
+            maxs = np.pad(maxs, (0, pad), constant_values=-np.inf)\
+                    .reshape(-1, factor).max(axis=1)
+            block *= factor
+
+    def envelope(self, start, stop, maxPoints):
+        """
+        points to draw the series over [start, stop)
+
+        Parameters
+        ----------
+            start, stop: int
+                sample range
+
+            maxPoints: int
+                upper bound on the number of points, ex. 2 x pixel width
+
+        Returns
+        -------
+            (x, y, raw): (np.ndarray, np.ndarray, bool)
+                raw is True when the samples themselves are returned;
+                otherwise each block gives its (min, max) at its centre
+        """
+        start, stop = max(int(start), 0), min(int(stop), self.n)
+        if stop <= start:
+            return np.empty(0), np.empty(0), True
+        if stop - start <= maxPoints:
+            return (np.arange(start, stop, dtype=float),
+                    np.asarray(self.series[start:stop]), True)
+        for block, mins, maxs in zip(self.blocks, self.mins, self.maxs):
+            if 2 * (stop - start) // block <= maxPoints:
+                break
+        first, last = start // block, -(-stop // block)
+        x = np.repeat(np.minimum((np.arange(first, last) + 0.5) * block,
+                                 self.n - 1), 2)
+        y = np.empty(len(x), dtype=np.float32)
+        y[0::2] = mins[first:last]
+        y[1::2] = maxs[first:last]
+        return x, y, False
+
+    def extent(self, start=0, stop=None):
+        """ (min, max) of the series over about [start, stop) """
+        _, y, _ = self.envelope(start, self.n if stop is None else stop,
+                                READ_ROWS)
+        return float(y.min()), float(y.max())
+
+
 class OpalCapture:
     """ class to capture Opal sensor data """
-    def __init__(self, sensors, is_v2=False, **kwargs):
+    def __init__(self, sensors, **kwargs):
         """
         Parameters
         ----------
-            sensors: HDF5 file mode 'r' 
-                output of h5py.File(*, 'r')
+            sensors: recording.SensorRecording
+                see open_recording; it is read lazily, so
+                close it with OpalCapture.close()
 
-            is_v2: bool
-                identify if data from V2 sensor
+            kwargs:
+                passed to get_mag (det_opt, stream)
 
         Returns
         -------
             None (check attributes)
         """
-        if is_v2:
-            self.labels = ['LEFT', 'RIGHT']
-            sids = list(sensors['Sensors'].keys())
-            # If label is 'Right Leg' or 'Pie derecho', then ridx = 1
-            ridx = any(x in sensors['Sensors'][sids[1]]\
-                    ['Configuration'].attrs["Label 0"].decode().lower()
-                       for x in ['right', 'derecho'])
-            sensordict = {'LEFT': sensors['Sensors'][sids[not ridx]],
-                          'RIGHT': sensors['Sensors'][sids[ridx]]}
-        else:
-            self.labels = list(map(lambda k: k.decode('UTF-8'),
-                                   sensors.attrs['MonitorLabelList']))
-            sids = map(lambda k: k.decode('UTF-8'),
-                       sensors.attrs['CaseIdList'])
-            sensordict = {x: sensors[y] for x, y in zip(self.labels, sids)}
-
-        self.sensorTs = sensordict[self.labels[0]]['Time'][:]
+        self.sensors = sensors
+        self.labels = sensors.labels
+        self.sensorTs = sensors.times[self.labels[0]]
         self.dp_idx = 0
+        self.sampleRate = sensors.sample_rate
+        self.accmags = self.get_mag(sensors.acc, self.dp_idx, **kwargs)
 
-        if is_v2:
-            self.accmags = self.get_mag(
-                    {x: sensordict[x]['Accelerometer']
-                     for x in self.labels}, self.dp_idx)
-        else:
-            self.accmags = self.get_mag(
-                {x: sensordict[x]['Calibrated']['Accelerometers']
-                 for x in self.labels}, self.dp_idx)
+        # EnvelopePyramid per label, built on first use
+        self.pyramids = {}
+
+    def close(self):
+        """ close the file(s) this capture reads from """
+        self.sensors.close()
+
+    def pyramid(self, label):
+        """ the EnvelopePyramid of accmags[label], built once """
+        if label not in self.pyramids:
+            self.pyramids[label] = EnvelopePyramid(self.accmags[label])
+        return self.pyramids[label]
 
     def update(self, in_time, tz):
         """
@@ -240,38 +652,98 @@ class OpalCapture:
                 [YYYY, MM, DD, HH, mm, SS.SSS], maybe not msec
 
             tz: pytz.tzfile
-                ex. pytz.timezone('America/Los_Angeles')
+                ex. pytz.timezone('America/Los_Angeles'); not used
+                for recordings kept in device time (Ax6)
 
         Returns
         -------
             dp_idx: int
                 the index near the start of the recording (initially 0)
+                If the recording started before the first sample, 0.
+
+        Raises
+        ------
+            ValueError
+                if the recording started after the last sample
         """
         # Trim data, using the time provided...
         # .h5 filename's first number (ex. 20160606-xxxx.h5) -> YYYYMMDD
         # Time is entered in the MainWindow and provided separately.
-        rec_start = datetime(*in_time)
-        rec_start_tz = tz.localize(rec_start)
-        # Iterate to find the first time point of sensor recording
-        # that's Greater than rec_start,
-        idx = 0
-        while True:
-            sensorT = datetime.fromtimestamp(self.sensorTs[idx]/1e6,
-                                             tz = pytz.UTC)
-            if sensorT > rec_start_tz.astimezone(pytz.utc):
-                break
-            idx += 1
+        if self.sensors.local_time:
+            tz = pytz.utc
+        rec_start_us = self.to_epoch_us(in_time, tz)
+        # The last time point of sensor recording that's
+        # not greater than rec_start (binary search on 'Time')
+        idx = int(self.sample_index(rec_start_us))
+        if idx < 0:
+            print("Recording start precedes the first sample; using sample 0")
+            idx = 0
+        elif rec_start_us > self.sensorTs[-1]:
+            raise ValueError("Recording start is after the last sample "
+                             f"({len(self.sensorTs)} samples)")
+
+        self.dp_idx = idx
+        return self.dp_idx
+
+    @staticmethod
+    def to_epoch_us(in_time, tz):
+        """
+        localize [YYYY, MM, DD, HH, mm, SS] and convert it to
+        microseconds since the epoch, the unit of the 'Time' dataset
+        """
+        rec_start_tz = tz.localize(datetime(*in_time))
+        return (rec_start_tz - EPOCH) // timedelta(microseconds=1)
+
+    def sample_index(self, t_us):
+        """
+        index of the last sample recorded at or before t_us
 
-        self.dp_idx = idx - 1
+        Parameters
+        ----------
+            t_us: int or array-like
+                time(s) in microseconds since the epoch
+
+        Returns
+        -------
+            idx: int or np.ndarray
+                -1 where t_us precedes the first sample
+        """
+        return np.asarray(self.sensorTs.searchsorted(t_us, side='right')) - 1
 
-    def get_mag(self, sensors, row_idx=0, det_opt='median'):
+    def sample_ranges(self, starts_us, ends_us):
+        """
+        resolve many start/end pairs to sample index ranges in one call
+
+        Parameters
+        ----------
+            starts_us, ends_us: array-like
+                start and end times in microseconds since the epoch
+
+        Returns
+        -------
+            (start_idx, end_idx): tuple of np.ndarray
+                data[start_idx[i]:end_idx[i]] covers the i-th pair;
+                both are clipped to [0, number of samples], so a pair
+                entirely outside the recording gives an empty slice
+        """
+        starts_us = np.atleast_1d(starts_us)
+        n = len(self.sensorTs)
+        start_idx = np.clip(self.sample_index(starts_us), 0, n)
+        end_idx = self.sensorTs.searchsorted(np.atleast_1d(ends_us),
+                                             side='right')
+        # A start after the last sample should not point at that sample
+        start_idx[starts_us > self.sensorTs[-1]] = n
+        return start_idx, np.maximum(end_idx, start_idx)
+
+    def get_mag(self, sensors, row_idx=0, det_opt='median', stream=False):
         """
         Calculating the norm of tri-axial accelerometer values
 
         Parameters
         ----------
             sensors: dict
-                {label: Nx3 accelerometer readings}
+                {label: Nx3 accelerometer readings
+                 (recording.H5Window or recording.ArrayWindow)}
 
             row_idx: int
                 index of the data point to start trimming data
@@ -279,27 +751,23 @@ class OpalCapture:
             det_opt: str
                 method to detrend the magnitude; default set to 'median'
 
+            stream: bool
+                estimate the median in bounded memory
+                (see recording.streaming_median for the error bound)
+
         Returns
         -------
             outdict: dict
                 keys: sensors.keys
-                values: detrended accmagnitudes
+                values: detrended accmagnitudes (MagnitudeSeries),
+                    read and computed chunk by chunk when sliced
         """
         if det_opt not in ['median', 'customfunc']:
             det_opt = 'median'
             print('Unknown detrending option - setting it to [median]')
 
-        def linalg_norm(arr, row_idx):
-            return np.linalg.norm(arr[row_idx:], axis=1)
-
-        mags = map(lambda x: linalg_norm(x, row_idx), list(sensors.values()))
-
-        if det_opt == 'median':
-            out = map(lambda x: x - np.median(x), mags)
-        else:
-            out = map(lambda x: x - np.array([9.80665]), mags)
-
-        return dict(zip(sensors.keys(), out))
+        return {k: MagnitudeSeries(v, row_idx, det_opt, stream)
+                for k, v in sensors.items()}
 
 
 class GraphDisplayWidget(FigureCanvas):
@@ -329,6 +797,13 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("matching video and sensor data")
 
         self.capture = None # Why None though?
+        self.sensorcapture = None
+        # Sensor sample plotted at x = 0; None until lockTime
+        self.plotStart = None
+        # Video frame shown at the time of sample plotStart
+        self.alignFrame = None
+        # Graph background under the frame cursor, for blitting
+        self._cursorBg = None
         self.isVideoFileLoaded = False
         self.h5FileName = None
         self.videoFileName = None
@@ -340,7 +815,7 @@ class MainWindow(QMainWindow):
 
         self.openH5File = QAction("&Open h5 File")
         self.openH5File.setShortcut("Ctrl+Shift+H")
-        self.openH5File.setStatusTip("Open a .h5 file")
+        self.openH5File.setStatusTip("Open a .h5 file, or a pair of .cwa files")
         self.openH5File.triggered.connect(self.loadH5File)
 
         self.quitAction = QAction("&Exit")
@@ -386,10 +861,9 @@ class MainWindow(QMainWindow):
         tzboxlbl.setFont(lblfont)
         tzbox.addWidget(tzboxlbl)
         self.timezone = QComboBox()
-        all_tz = pytz.all_timezones
-        self.timezone.addItems(all_tz)
+        self.timezone.setModel(timezone_model())
         # Default set to 'America/Los_Angeles'
-        self.timezone.setCurrentIndex(all_tz.index('America/Los_Angeles'))
+        self.timezone.setCurrentText('America/Los_Angeles')
         tzbox.addWidget(self.timezone)
 
         vidbox = QVBoxLayout()
@@ -504,6 +978,17 @@ class MainWindow(QMainWindow):
         self._left, = self.graphDisplayWidget.axes.plot(t, np.sin(t), marker='o', color='pink', label='Left')
         self._right, = self.graphDisplayWidget.axes.plot(t, np.cos(t), marker="o", color='skyblue', label='Right')
         self.graphDisplayWidget.axes.legend()
+        # Zooming or panning with the toolbar re-fetches the traces
+        self.graphDisplayWidget.axes.callbacks.connect(
+                'xlim_changed', lambda _: self.refreshTraces())
+        self.graphDisplayWidget.mpl_connect(
+                'resize_event', lambda _: self.refreshTraces())
+        # Current video frame on the sensor graph. It is animated: full
+        # draws leave it out, and moveCursor blits it over the cached
+        # background instead of redrawing the traces.
+        self._cursor = self.graphDisplayWidget.axes.axvline(
+                0, color='gray', animated=True, visible=False)
+        self.graphDisplayWidget.mpl_connect('draw_event', self.cacheCursorBg)
         #self.tabs = QTabWidget()
         #graphbox = QWidget()
         #graphbox.layout = QVBoxLayout(graphbox)
@@ -571,6 +1056,7 @@ class MainWindow(QMainWindow):
                     # frame_diff is from frame 0, so first make frameNumber = 0
                     self.capture.frameNumber = 0
                     self.capture.nextFrameSlot(frame_diff)
+                    self.alignFrame = self.capture.frameNumber
                     self.updateFrameInfo()
                     # parent, h5filename, in_time, tz
                     # preparing in_time....
@@ -586,17 +1072,23 @@ class MainWindow(QMainWindow):
                     print(f"This is the sensor's starting idx: {startline}")
                     print("This is the sensor's time")
                     print(datetime.fromtimestamp(self.sensorcapture.sensorTs[startline]/1e6, pytz.UTC))
-                    left = self.sensorcapture.accmags['LEFT'][startline:]
-                    right = self.sensorcapture.accmags['RIGHT'][startline:]
+                    # Envelopes of both sides, served at screen resolution
+                    left = self.sensorcapture.pyramid('LEFT')
+                    right = self.sensorcapture.pyramid('RIGHT')
+                    lmin, lmax = left.extent(startline)
+                    rmin, rmax = right.extent(startline)
                     # You need to mind the frame number
-                    self.graphDisplayWidget.axes.set_ylim(min(left),max(left))
+                    self.graphDisplayWidget.axes.set_ylim(min(lmin, rmin),
+                                                          max(lmax, rmax))
                     # Show 1s window
                     # self.graphDisplayWidget.axes.axvline(self.capture.frameNumber, ymin=0, ymax=10)
-                    self._left.set_data(range(len(left)), left)
-                    self._right.set_data(range(len(right)), right)
+                    self.plotStart = startline
+                    # set_xlim re-fetches the traces through xlim_changed
+                    self.graphDisplayWidget.axes.set_xlim(
+                            0, max(left.n, right.n) - startline)
                     self.graphDisplayWidget.axes.legend()
-                    self._left.figure.canvas.draw()
-                    self._right.figure.canvas.draw()
+                    self.graphDisplayWidget.draw()
+                    self.moveCursor(self.capture.frameNumber)
                     print("sensor capture successful")
                 except:
                     print("Something's not right.\
@@ -607,6 +1099,53 @@ class MainWindow(QMainWindow):
         else:
             print("Video not loaded. Nothing will happen")
 
+    def refreshTraces(self):
+        """ re-fetch both traces for the visible x range and width """
+        if self.plotStart is None:
+            return
+        axes = self.graphDisplayWidget.axes
+        x0, x1 = axes.get_xlim()
+        start = self.plotStart + max(int(np.floor(x0)), 0)
+        stop = self.plotStart + int(np.ceil(x1)) + 1
+        maxPoints = 2 * max(int(axes.bbox.width), 1)
+        for line, label in ((self._left, 'LEFT'), (self._right, 'RIGHT')):
+            x, y, raw = self.sensorcapture.pyramid(label).envelope(
+                    start, stop, maxPoints)
+            line.set_data(x - self.plotStart, y)
+            # Markers only once individual samples are visible
+            line.set_marker('o' if raw else 'None')
+        self.graphDisplayWidget.draw_idle()
+
+    def cacheCursorBg(self, event):
+        """ keep the freshly drawn graph, then put the cursor on it """
+        axes = self.graphDisplayWidget.axes
+        self._cursorBg = self.graphDisplayWidget.copy_from_bbox(axes.bbox)
+        axes.draw_artist(self._cursor)
+
+    def moveCursor(self, frameNumber):
+        """
+        mark frameNumber on the sensor graph
+
+        The frame's time from the aligned frame (see lockTime) is
+        converted to samples with the sensor's sample rate; only the
+        cursor is redrawn, over the cached background.
+        """
+        if self.plotStart is None or self.alignFrame is None:
+            return
+        sec = (self.capture.timestamp(frameNumber) -
+               self.capture.timestamp(self.alignFrame)) / 1000
+        x = sec * self.sensorcapture.sampleRate
+        self._cursor.set_xdata([x, x])
+        self._cursor.set_visible(True)
+        if self._cursorBg is None:
+            # Nothing cached yet; the next draw_event will blit it
+            self.graphDisplayWidget.draw_idle()
+            return
+        canvas = self.graphDisplayWidget
+        canvas.restore_region(self._cursorBg)
+        canvas.axes.draw_artist(self._cursor)
+        canvas.blit(canvas.axes.bbox)
+
     def resetReq(self):
         """ Reset provided input """
         self.videoCapturePoint.setEnabled(True)
@@ -617,6 +1156,9 @@ class MainWindow(QMainWindow):
         self.sensorCaptureDate.clear()
         self.videoFileName = ""
         self.h5FileName = ""
+        self.plotStart = None
+        self.alignFrame = None
+        self._cursor.set_visible(False)
         self.videoFileNameLabel.setText("")
         self.h5FileNameLabel.setText("")
         self.fps.setText("")
@@ -627,6 +1169,7 @@ class MainWindow(QMainWindow):
             # canvas.fill(QColor("white"))
             self.videoDisplayWidget.customLayout.removeWidget(self.capture.video_frame)
             # self.capture.video_frame.setPixmap(canvas)
+            self.capture.deleteLater()
             self.capture = None
         except:
             print("Hmm")
@@ -638,22 +1181,40 @@ class MainWindow(QMainWindow):
             shortform = self.videoFileName.split(sep="/")[-1]
             self.videoFileNameLabel.setText(shortform)
             self.isVideoFileLoaded = True
+            if self.capture is not None:
+                self.capture.deleteLater()
             self.capture = VideoCapture(self.videoFileName, self.videoDisplayWidget)
+            self.capture.frameChanged.connect(self.moveCursor)
             self.updateFrameInfo()
         except:
             print("Please select a .h264 file")
 
     def loadH5File(self):
-        self.h5FileName = QFileDialog.getOpenFileName(self, "Select a .h5 file")[0]
+        self.h5FileName = QFileDialog.getOpenFileName(self,
+                "Select a .h5 file (or the LEFT .cwa file)", "",
+                "Sensor files (*.h5 *.hdf5 *.cwa)")[0]
+        if not self.h5FileName:
+            return
         shortform = self.h5FileName.split(sep="/")[-1]
+        # An Ax6 recording is a pair of .cwa files, left then right
+        rightFileName = None
+        if self.h5FileName.lower().endswith('.cwa'):
+            rightFileName = QFileDialog.getOpenFileName(self,
+                    "Select the RIGHT .cwa file", "", "cwa files (*.cwa)")[0]
+            if not rightFileName:
+                print("An Ax6 recording needs a RIGHT .cwa file")
+                return
+            shortform += " / " + rightFileName.split(sep="/")[-1]
         self.h5FileNameLabel.setText(shortform)
         self.isH5FileLoaded = True
-        # Identify if it's OPAL V1 or V2
-        with h5py.File(self.h5FileName, 'r') as preview:
-            if 'MonitorLabelList' in preview.attrs:
-                self.sensorcapture = OpalCapture(preview)
-            else:
-                self.sensorcapture = OpalCapture(preview, is_v2=True)
+        # The file stays open; OpalCapture reads it window by window
+        if self.sensorcapture is not None:
+            self.sensorcapture.close()
+            self.plotStart = None
+        # Opal V1, V2 or Ax6, told apart by open_recording
+        # Detrend with the streaming median so memory stays bounded
+        self.sensorcapture = OpalCapture(
+                open_recording(self.h5FileName, rightFileName), stream=True)
 
     def updateFrameInfo(self, cond=True, addFrame=1):
         """
@@ -673,8 +1234,8 @@ class MainWindow(QMainWindow):
         fn_updated = min(fn_updated, self.capture.numFrames-1)
         # Frame Number set!
         self.curfnum.setText(str(fn_updated+1))
-        # Frame Number based video time estimate
-        estmsec = (fn_updated / self.capture.fps)*1000
+        # Presentation time of the frame, from the keyframe index
+        estmsec = self.capture.timestamp(fn_updated)
         estsecmin = estmsec // 1000
         estmin = estsecmin // 60
         estsec = estsecmin % 60
@@ -701,4 +1262,5 @@ if __name__ == '__main__':
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    warm_up(cv2, h5py)
     sys.exit(app.exec())